@@ -0,0 +1,129 @@
+# Monte Carlo practice opponent.
+#
+# The search runs on the rules engine in a worker process, so a slow decision
+# never blocks the bot's event loop. It is anytime: it keeps sampling random
+# playouts until the time budget runs out and then plays the pair of plays
+# that was explored the most.
+
+import os
+import math
+import time
+import random
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import engine
+
+DEFAULT_TIME_BUDGET = float(os.environ.get("DUELBOT_AI_BUDGET", "2.0"))
+# duels that run longer than this in a playout are scored as a draw
+MAX_PLAYOUT_TURNS = 100
+
+SPECIALS = tuple(i for i in range(engine.NUM_PLAYS) if engine.IS_SPECIAL[i])
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        # By now the bot has database threads running, so don't fork it:
+        # forkserver workers fork from a clean single-threaded server.
+        # Workers under both re-import the main module, see main.py.
+        methods = multiprocessing.get_all_start_methods()
+        method = "forkserver" if "forkserver" in methods else "spawn"
+        _executor = ProcessPoolExecutor(mp_context=multiprocessing.get_context(method))
+    return _executor
+
+
+def shutdown_executor():
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(cancel_futures=True)
+        _executor = None
+
+
+def _determinise(state, side, rng):
+    # the opponent's special is hidden, so guess one they could have been dealt
+    own_special = state[engine.P1_SPECIAL if side == 0 else engine.P2_SPECIAL]
+    guess = rng.choice([s for s in SPECIALS if s != own_special])
+    index = engine.P2_SPECIAL if side == 0 else engine.P1_SPECIAL
+    return state[:index] + (guess,) + state[index + 1 :]
+
+
+def _play_turn(state, p1pair, p2pair):
+    state = engine.step(state, p1pair[0], p2pair[0])[0]
+    if engine.winner(state):
+        return state
+    return engine.step(state, p1pair[1], p2pair[1])[0]
+
+
+def _playout(state, pair, other_pair, side, rng):
+    # returns 1 if side wins, 0 if it loses and 0.5 if the playout runs out
+    if side == 0:
+        state = _play_turn(state, pair, other_pair)
+    else:
+        state = _play_turn(state, other_pair, pair)
+    for _ in range(MAX_PLAYOUT_TURNS):
+        result = engine.winner(state)
+        if result:
+            return 1 if result == side + 1 else 0
+        state = _play_turn(
+            state,
+            rng.choice(engine.legal_pairs(state, 0)),
+            rng.choice(engine.legal_pairs(state, 1)),
+        )
+    result = engine.winner(state)
+    if result:
+        return 1 if result == side + 1 else 0
+    return 0.5
+
+
+def search(state, side, time_budget, seed=None):
+    # UCB1 over our own (first, second) pairs, the opponent plays randomly
+    rng = random.Random(seed)
+    pairs = engine.legal_pairs(state, side)
+    if len(pairs) == 1:
+        return pairs[0]
+    other = 1 - side
+    visits = [0] * len(pairs)
+    wins = [0.0] * len(pairs)
+    total = 0
+    deadline = time.perf_counter() + time_budget
+
+    while total < len(pairs) or time.perf_counter() < deadline:
+        if total < len(pairs):
+            i = total
+        else:
+            log_total = math.log(total)
+            i = max(
+                range(len(pairs)),
+                key=lambda j: wins[j] / visits[j]
+                + math.sqrt(2 * log_total / visits[j]),
+            )
+        world = _determinise(state, side, rng)
+        other_pair = rng.choice(engine.legal_pairs(world, other))
+        wins[i] += _playout(world, pairs[i], other_pair, side, rng)
+        visits[i] += 1
+        total += 1
+
+    return pairs[max(range(len(pairs)), key=visits.__getitem__)]
+
+
+class MonteCarloAI:
+    def __init__(self, time_budget=DEFAULT_TIME_BUDGET, executor=None, seed=None):
+        self.time_budget = time_budget
+        self.executor = executor
+        # each search gets its own seed from this stream, so workers never
+        # share a generator
+        self.rng = random.Random(seed)
+
+    async def choose(self, state, side):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor or get_executor(),
+            search,
+            state,
+            side,
+            self.time_budget,
+            self.rng.getrandbits(64),
+        )
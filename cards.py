@@ -1,15 +1,24 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from enum import Enum
 
+# category bits
+ATTACK = 1
+MOVE = 2
+SPECIAL = 4
+CHANGES_STANCE = 8
+
 
 class Stance(Enum):
     HEAVEN = "Heaven"
     EARTH = "Earth"
 
 
-@dataclass
+# cards compare and hash by identity, so membership checks never compare fields
+@dataclass(frozen=True, slots=True, eq=False)
 class Card:
     name: str
+    id: int
+    category: int
 
     def __lt__(self, other):
         if not isinstance(other, Card):
@@ -17,7 +26,7 @@ class Card:
         return self.name < other.name
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class AttackCard(Card):
     button_text: str
     is_special: bool
@@ -25,15 +34,22 @@ class AttackCard(Card):
     miss_msg: str
     counter_msg: str
     clash_msg: str
-    hits_cells: list[int]
+    hits_cells: tuple[int, ...]
     requires_stance: Stance
     changes_stance: bool
     button_colour: str
+    # bit n is set if the card hits n cells ahead
+    hits_mask: int = field(init=False)
+
+    def __post_init__(self):
+        object.__setattr__(self, "hits_mask", sum(1 << c for c in self.hits_cells))
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class MoveAction:
     name: str
+    id: int
+    category: int
     button_colour: str
     button_text: str
     magnitude: int
@@ -46,7 +62,7 @@ class MoveAction:
         return self.name < other.name
 
 
-@dataclass
+@dataclass(frozen=True, slots=True, eq=False)
 class MoveCard(Card):
     actions: tuple[MoveAction, MoveAction]
 
@@ -54,13 +70,15 @@ class MoveCard(Card):
 ############################ special
 zantetsu = AttackCard(
     name="Zan-Tetsu Strike",
+    id=0,
+    category=ATTACK | SPECIAL | CHANGES_STANCE,
     button_text="Zan-Tetsu Strike (2 & 3)",
     is_special=True,
     success_msg="{a} rises and unleashes a devastating Zan-Tetsu strike, and {b} takes the full force of the blow!",
     miss_msg="{a} rises and attempts a Zan-Tetsu strike, but {b} deftly evades!",
     counter_msg="{a} rises and attempts a Zan-Tetsu strike...",
     clash_msg="{a} rises and attempts a Zan-Tetsu strike...",
-    hits_cells=[2, 3],
+    hits_cells=(2, 3),
     requires_stance=Stance.EARTH,
     changes_stance=True,
     button_colour="yellow",
@@ -68,13 +86,15 @@ zantetsu = AttackCard(
 
 kesa = AttackCard(
     name="Kesa Strike",
+    id=1,
+    category=ATTACK | SPECIAL | CHANGES_STANCE,
     button_text="Kesa Strike (same cell & 1)",
     is_special=True,
     success_msg="{a} drops low and launches a piercing Kesa strike! {b} can't turn it aside!",
     miss_msg="{a} drops low and attempts a Kesa strike, but {b} manages to evade!",
     counter_msg="{a} drops low and attempts a Kesa strike...",
     clash_msg="{a} drops low and attempts a Kesa strike...",
-    hits_cells=[0, 1],
+    hits_cells=(0, 1),
     requires_stance=Stance.HEAVEN,
     changes_stance=True,
     button_colour="green",
@@ -82,13 +102,15 @@ kesa = AttackCard(
 
 counter = AttackCard(
     name="Counterattack",
+    id=2,
+    category=SPECIAL,
     button_text="Counterattack",
     is_special=True,
     success_msg=None,
     miss_msg=None,
     counter_msg=None,
     clash_msg=None,
-    hits_cells=[],
+    hits_cells=(),
     requires_stance=None,
     changes_stance=False,
     button_colour="orange",
@@ -98,13 +120,15 @@ counter = AttackCard(
 
 low_strike = AttackCard(
     name="Low Strike",
+    id=3,
+    category=ATTACK,
     button_text="Low Strike (1)",
     is_special=False,
     success_msg="{a} throws out a swift low strike, and the attack finds its mark!",
     miss_msg="{a} attempts a low strike, but {b} bats it aside!",
     counter_msg="{a} delivers a swift low strike...",
     clash_msg="{a} delivers a swift low strike...",
-    hits_cells=[1],
+    hits_cells=(1,),
     requires_stance=Stance.EARTH,
     changes_stance=False,
     button_colour="green",
@@ -112,13 +136,15 @@ low_strike = AttackCard(
 
 high_strike = AttackCard(
     name="High Strike",
+    id=4,
+    category=ATTACK,
     button_text="High Strike (2)",
     is_special=False,
     success_msg="{a} brings down a fierce high strike directly onto {b}!",
     miss_msg="{a} attempts a high strike, but {b} avoids the blow!",
     counter_msg="{a} attempts a fierce high strike...",
     clash_msg="{a} attempts a fierce high strike...",
-    hits_cells=[2],
+    hits_cells=(2,),
     requires_stance=Stance.HEAVEN,
     changes_stance=False,
     button_colour="yellow",
@@ -126,13 +152,15 @@ high_strike = AttackCard(
 
 balanced_strike = AttackCard(
     name="Balanced Strike",
+    id=5,
+    category=ATTACK,
     button_text="Balanced Strike (same cell)",
     is_special=False,
     success_msg="{a} delivers a balanced strike!",
     miss_msg="{a} attempts a balanced strike, but {b} dodges!",
     counter_msg="{a} delivers a balanced strike...",
     clash_msg="{a} delivers a balanced strike...",
-    hits_cells=[0],
+    hits_cells=(0,),
     requires_stance=None,
     changes_stance=False,
     button_colour="grey",
@@ -142,6 +170,8 @@ balanced_strike = AttackCard(
 
 approach = MoveAction(
     name="Approach",
+    id=6,
+    category=MOVE,
     magnitude=1,
     msg="{a} steps forward.",
     button_colour="blue",
@@ -150,6 +180,8 @@ approach = MoveAction(
 )
 retreat = MoveAction(
     name="Retreat",
+    id=7,
+    category=MOVE,
     magnitude=-1,
     msg="{a} steps back.",
     button_colour="blue",
@@ -158,6 +190,8 @@ retreat = MoveAction(
 )
 charge = MoveAction(
     name="Charge",
+    id=8,
+    category=MOVE,
     magnitude=2,
     msg="{a} charges forward!",
     button_colour="blue",
@@ -166,6 +200,8 @@ charge = MoveAction(
 )
 change_stance = MoveAction(
     name="Change Stance",
+    id=9,
+    category=MOVE | CHANGES_STANCE,
     magnitude=0,
     msg="{a} shifts into {other_stance} stance.",
     button_colour="blue",
@@ -175,9 +211,11 @@ change_stance = MoveAction(
 
 ########################## movement cards
 
-footwork = MoveCard(name="Footwork", actions=(approach, retreat))
+footwork = MoveCard(name="Footwork", id=10, category=MOVE, actions=(approach, retreat))
 
-tactics = MoveCard(name="Tactics", actions=(charge, change_stance))
+tactics = MoveCard(
+    name="Tactics", id=11, category=MOVE, actions=(charge, change_stance)
+)
 
 attack_cards = (zantetsu, kesa, low_strike, high_strike, balanced_strike)
 move_cards = (footwork, tactics)
@@ -185,6 +223,24 @@ special_attack_cards = (zantetsu, kesa, counter)
 move_actions = (approach, retreat, charge, change_stance)
 # stance_change_cards_or_actions = [zantetsu, kesa, change_stance]
 
+# every card and action, indexed by id; ids below len(plays) are playable
+cards_by_id = (
+    zantetsu,
+    kesa,
+    counter,
+    low_strike,
+    high_strike,
+    balanced_strike,
+    approach,
+    retreat,
+    charge,
+    change_stance,
+    footwork,
+    tactics,
+)
+plays = cards_by_id[:10]
+assert all(card.id == i for i, card in enumerate(cards_by_id))
+
 
 def attack_card_or_move_action_from_string(card_name: str):
     for card in attack_cards + move_actions:
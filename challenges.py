@@ -0,0 +1,102 @@
+# Open challenges, waiting for the opponent to accept.
+#
+# Each player has at most one open challenge per channel (a new one replaces
+# it) and at most per_user across all channels. Challenges are indexed by
+# (channel, challenger), by challenger and by opponent, so accepting, capping
+# and listing someone's incoming challenges never scan the registry. They
+# expire through the timer wheel.
+
+import time
+from dataclasses import dataclass
+from typing import Optional
+import discord
+from timers import Timer, wheel
+
+# the stored interaction can't be followed up after 15 minutes anyway
+CHALLENGE_TIMEOUT = 15 * 60
+MAX_CHALLENGES_PER_USER = 3
+
+
+@dataclass(slots=True, eq=False)
+class Challenge:
+    channel_id: int
+    challenger_id: int
+    opponent_id: int
+    interaction: discord.Interaction
+    emoji: Optional[str]
+    created_at: float
+    timer: Optional[Timer] = None
+
+
+class ChallengeRegistry:
+    def __init__(self, ttl=CHALLENGE_TIMEOUT, per_user=MAX_CHALLENGES_PER_USER):
+        self.ttl = ttl
+        self.per_user = per_user
+        # (channel_id, challenger_id) -> Challenge
+        self.challenges = {}
+        # user_id -> {(channel_id, challenger_id), ...}
+        self.by_challenger = {}
+        self.by_opponent = {}
+        self.expired = 0
+        self.rejected = 0
+
+    def __len__(self):
+        return len(self.challenges)
+
+    def add(self, channel_id, challenger_id, opponent_id, interaction, emoji):
+        # the new Challenge, or None if the challenger is at their cap
+        key = (channel_id, challenger_id)
+        self._remove(key)
+        if len(self.by_challenger.get(challenger_id, ())) >= self.per_user:
+            self.rejected += 1
+            return None
+        challenge = Challenge(
+            channel_id, challenger_id, opponent_id, interaction, emoji, time.time()
+        )
+        challenge.timer = wheel.schedule(self.ttl, self._expire, key, challenge)
+        self.challenges[key] = challenge
+        self.by_challenger.setdefault(challenger_id, set()).add(key)
+        self.by_opponent.setdefault(opponent_id, set()).add(key)
+        return challenge
+
+    def take(self, channel_id, challenger_id, opponent_id):
+        # removes and returns challenger's open challenge to opponent here
+        challenge = self.challenges.get((channel_id, challenger_id))
+        if challenge is None or challenge.opponent_id != opponent_id:
+            return None
+        self._remove((channel_id, challenger_id))
+        return challenge
+
+    def incoming(self, user_id):
+        return [self.challenges[key] for key in self.by_opponent.get(user_id, ())]
+
+    def outgoing(self, user_id):
+        return [self.challenges[key] for key in self.by_challenger.get(user_id, ())]
+
+    def _expire(self, key, challenge):
+        if self.challenges.get(key) is challenge:
+            self._remove(key)
+            self.expired += 1
+
+    def _remove(self, key):
+        challenge = self.challenges.pop(key, None)
+        if challenge is None:
+            return
+        challenge.timer.cancel()
+        for index, user_id in (
+            (self.by_challenger, challenge.challenger_id),
+            (self.by_opponent, challenge.opponent_id),
+        ):
+            keys = index[user_id]
+            keys.discard(key)
+            if not keys:
+                del index[user_id]
+
+    def stats(self):
+        return {
+            "open": len(self.challenges),
+            "challengers": len(self.by_challenger),
+            "opponents": len(self.by_opponent),
+            "expired": self.expired,
+            "rejected": self.rejected,
+        }
@@ -1,14 +1,69 @@
+import queue
 import sqlite3
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from lru import LRUCache
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# tells the writer thread to commit what it has and stop
+_STOP = object()
 
 
 class DatabaseHandler:
-    def __init__(self, db_name):
-        self.conn = sqlite3.connect(db_name)
-        self.cursor = self.conn.cursor()
-        self.create_tables()
+    # All writes go through one writer thread that batches them into group
+    # commits, so the event loop never waits on an fsync. Write methods return
+    # a future that resolves once the write is committed; awaiting it is
+    # optional. Each write is a list of statements applied all or nothing.
+    # Reads run on a small pool of read-only connections and only see
+    # committed writes.
+
+    def __init__(
+        self,
+        db_name,
+        commit_interval=0.05,
+        max_batch=256,
+        read_connections=4,
+        stats_cache_size=1024,
+    ):
+        self.db_name = db_name
+        # (user_id, server_id) -> (wins, losses), kept current by update_stats
+        self.stats_cache = LRUCache(stats_cache_size)
+        # (user_id, server_id) -> [loads in flight, updates seen during them]
+        self._stats_loads = {}
+        self.commit_interval = commit_interval
+        self.max_batch = max_batch
+        self._queue = queue.Queue()
+        self._ready = threading.Event()
+        self._writer = threading.Thread(
+            target=self._write_loop, name="db-writer", daemon=True
+        )
+        self._writer.start()
+        self._ready.wait()
+        self._readers = ThreadPoolExecutor(
+            max_workers=read_connections, thread_name_prefix="db-reader"
+        )
+        self._reader_local = threading.local()
 
-    def create_tables(self):
-        self.cursor.execute(
+    def _connect_writer(self):
+        conn = sqlite3.connect(self.db_name)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _reader(self):
+        conn = getattr(self._reader_local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(f"file:{self.db_name}?mode=ro", uri=True)
+            self._reader_local.conn = conn
+        return conn
+
+    def create_tables(self, cursor):
+        cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS game_stats (
                 user_id INTEGER,
@@ -19,7 +74,7 @@ class DatabaseHandler:
             )
         """
         )
-        self.cursor.execute(
+        cursor.execute(
             """
             CREATE TABLE IF NOT EXISTS configured_channels (
                 guild_id INTEGER PRIMARY KEY,
@@ -27,10 +82,284 @@ class DatabaseHandler:
             )
         """
         )
-        self.conn.commit()
+        # warn_before is NULL when players shouldn't be warned
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS guild_settings (
+                guild_id INTEGER PRIMARY KEY,
+                turn_timeout INTEGER,
+                warn_before INTEGER
+            )
+        """
+        )
+        # guild_id 0 holds the global rating
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS ratings (
+                user_id INTEGER,
+                guild_id INTEGER,
+                rating REAL,
+                games INTEGER DEFAULT 0,
+                PRIMARY KEY (user_id, guild_id)
+            )
+        """
+        )
+        # match history: one row per finished duel, one per player per duel
+        # and one per turn; old rows get rolled up into match_rollups
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS matches (
+                match_id INTEGER PRIMARY KEY,
+                guild_id INTEGER,
+                p1_id INTEGER,
+                p2_id INTEGER,
+                p1_special INTEGER,
+                p2_special INTEGER,
+                turns INTEGER,
+                winner_id INTEGER,
+                forfeit INTEGER,
+                started_at REAL,
+                ended_at REAL,
+                seed INTEGER
+            )
+        """
+        )
+        # seed was added after matches; bring older databases up to date
+        columns = [row[1] for row in cursor.execute("PRAGMA table_info(matches)")]
+        if "seed" not in columns:
+            cursor.execute("ALTER TABLE matches ADD COLUMN seed INTEGER")
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS matches_by_guild
+            ON matches (guild_id, ended_at)
+        """
+        )
+        cursor.execute(
+            "CREATE INDEX IF NOT EXISTS matches_by_end ON matches (ended_at)"
+        )
+        # won is NULL when both players timed out
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS match_players (
+                user_id INTEGER,
+                ended_at REAL,
+                match_id INTEGER,
+                guild_id INTEGER,
+                opponent_id INTEGER,
+                special INTEGER,
+                won INTEGER,
+                PRIMARY KEY (user_id, ended_at, match_id)
+            ) WITHOUT ROWID
+        """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS match_players_by_opponent
+            ON match_players (user_id, opponent_id, guild_id, won)
+        """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS match_players_by_special
+            ON match_players (user_id, special, guild_id, won)
+        """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS match_players_by_guild
+            ON match_players (guild_id, user_id, won)
+        """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS match_plays (
+                match_id INTEGER,
+                turn INTEGER,
+                p1_first INTEGER,
+                p1_second INTEGER,
+                p2_first INTEGER,
+                p2_second INTEGER,
+                PRIMARY KEY (match_id, turn)
+            ) WITHOUT ROWID
+        """
+        )
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS match_rollups (
+                user_id INTEGER,
+                opponent_id INTEGER,
+                special INTEGER,
+                guild_id INTEGER,
+                wins INTEGER DEFAULT 0,
+                losses INTEGER DEFAULT 0,
+                PRIMARY KEY (user_id, opponent_id, special, guild_id)
+            ) WITHOUT ROWID
+        """
+        )
+        cursor.execute(
+            """
+            CREATE INDEX IF NOT EXISTS match_rollups_by_special
+            ON match_rollups (user_id, special, guild_id, wins, losses)
+        """
+        )
+        # rolling up a group of only double timeouts used to store NULLs
+        cursor.execute(
+            """
+            UPDATE match_rollups
+            SET wins = COALESCE(wins, 0), losses = COALESCE(losses, 0)
+            WHERE wins IS NULL OR losses IS NULL
+        """
+        )
+
+    def create_live_tables(self, cursor):
+        # journal of duels still being played, see journal.py. A match's rows
+        # are deleted when it finishes.
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS live_matches (
+                match_id INTEGER PRIMARY KEY,
+                guild_id INTEGER,
+                channel_id INTEGER,
+                p1_id INTEGER,
+                p2_id INTEGER,
+                p1_name TEXT,
+                p2_name TEXT,
+                p1_emoji TEXT,
+                p2_emoji TEXT,
+                p1_special INTEGER,
+                p2_special INTEGER,
+                p2_ai INTEGER,
+                seed INTEGER,
+                started_at REAL
+            )
+        """
+        )
+        # one row per resolved turn-half: the turn's plays and the packed
+        # engine state after it
+        cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS live_match_events (
+                match_id INTEGER,
+                seq INTEGER,
+                p1_first INTEGER,
+                p1_second INTEGER,
+                p2_first INTEGER,
+                p2_second INTEGER,
+                state INTEGER,
+                PRIMARY KEY (match_id, seq)
+            ) WITHOUT ROWID
+        """
+        )
+
+    def _write_loop(self):
+        conn = self._connect_writer()
+        cursor = conn.cursor()
+        self.create_tables(cursor)
+        self.create_live_tables(cursor)
+        conn.commit()
+        self._ready.set()
+
+        stopping = False
+        while not stopping:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.commit_interval
+            while len(batch) < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+
+            stopping = any(item is _STOP for item in batch)
+            writes = [item for item in batch if item is not _STOP]
+            # one transaction per batch, with a savepoint per write so a failing
+            # write doesn't take the rest of the batch down with it
+            start = metrics.clock()
+            try:
+                cursor.execute("BEGIN")
+                results = []
+                for statements, future, loop in writes:
+                    cursor.execute("SAVEPOINT write")
+                    try:
+                        for sql, params in statements:
+                            # a list of parameter tuples means executemany
+                            if isinstance(params, list):
+                                cursor.executemany(sql, params)
+                            else:
+                                cursor.execute(sql, params)
+                        cursor.execute("RELEASE write")
+                        results.append((future, loop, None))
+                    except sqlite3.Error as e:
+                        cursor.execute("ROLLBACK TO write")
+                        cursor.execute("RELEASE write")
+                        results.append((future, loop, e))
+                conn.commit()
+            except Exception as e:
+                # the whole batch is lost, but the thread has to keep going or
+                # every write and barrier after it would wait forever
+                logger.exception(f"Couldn't commit a batch of {len(writes)} write(s)")
+                try:
+                    conn.rollback()
+                except sqlite3.Error:
+                    pass
+                results = [(future, loop, e) for _, future, loop in writes]
+            else:
+                metrics.DB_COMMIT.since(start)
+                metrics.DB_BATCH.observe(len(batch))
+
+            for future, loop, error in results:
+                if future is not None:
+                    self._resolve(future, loop, error)
+        conn.close()
+
+    def _resolve(self, future, loop, error):
+        def resolve():
+            if future.done():
+                return
+            if error is None:
+                future.set_result(None)
+            else:
+                future.set_exception(error)
+
+        try:
+            loop.call_soon_threadsafe(resolve)
+        except RuntimeError:
+            # the loop is already closed, nobody is waiting any more
+            pass
+
+    def _write(self, sql, params):
+        return self._write_many([(sql, params)])
+
+    def _write_many(self, statements):
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        future = loop.create_future() if loop else None
+        self._queue.put((statements, future, loop))
+        return future
+
+    async def _read(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        start = metrics.clock()
+        try:
+            return await loop.run_in_executor(self._readers, fn, *args)
+        finally:
+            metrics.DB_READ.since(start, fn.__name__)
 
     def update_stats(self, user_id, server_id, is_win):
-        self.cursor.execute(
+        key = (user_id, server_id)
+        cached = self.stats_cache.peek(key)
+        if cached is not None:
+            self.stats_cache.put(
+                key,
+                (cached[0] + (1 if is_win else 0), cached[1] + (0 if is_win else 1)),
+            )
+        if key in self._stats_loads:
+            self._stats_loads[key][1] += 1
+        return self._write(
             """
             INSERT INTO game_stats (user_id, server_id, wins, losses)
             VALUES (?, ?, ?, ?)
@@ -47,34 +376,355 @@ class DatabaseHandler:
                 0 if is_win else 1,
             ),
         )
-        self.conn.commit()
 
-    def get_stats(self, user_id, server_id):
-        self.cursor.execute(
-            """
+    def _get_stats(self, user_id, server_id):
+        result = (
+            self._reader()
+            .execute(
+                """
             SELECT wins, losses FROM game_stats
             WHERE user_id = ? AND server_id = ?
         """,
-            (user_id, server_id),
+                (user_id, server_id),
+            )
+            .fetchone()
         )
-        result = self.cursor.fetchone()
         if result:
-            return {"wins": result[0], "losses": result[1]}
-        return {"wins": 0, "losses": 0}
+            return (result[0], result[1])
+        return (0, 0)
+
+    async def get_stats(self, user_id, server_id):
+        key = (user_id, server_id)
+        cached = self.stats_cache.get(key)
+        if cached is None:
+            cached = await self._load_stats(key)
+        return {"wins": cached[0], "losses": cached[1]}
+
+    async def _load_stats(self, key):
+        # A miss first waits for every write queued so far to commit, so the
+        # read can't miss an update that was already counted. If update_stats
+        # runs while the read is in flight the result may be behind, so it is
+        # returned but not cached.
+        load = self._stats_loads.setdefault(key, [0, 0])
+        load[0] += 1
+        updates = load[1]
+        try:
+            await self._write_many([])
+            stats = await self._read(self._get_stats, *key)
+        finally:
+            load[0] -= 1
+            if not load[0]:
+                del self._stats_loads[key]
+        if load[1] == updates and key not in self.stats_cache:
+            self.stats_cache.put(key, stats)
+        return stats
 
     def set_configured_channel(self, guild_id, channel_id):
-        self.cursor.execute(
+        return self._write(
             """
             INSERT OR REPLACE INTO configured_channels (guild_id, channel_id)
             VALUES (?, ?)
         """,
             (guild_id, channel_id),
         )
-        self.conn.commit()
 
-    def get_configured_channels(self):
-        self.cursor.execute("SELECT guild_id, channel_id FROM configured_channels")
-        return dict(self.cursor.fetchall())
+    def _get_configured_channels(self):
+        return dict(
+            self._reader()
+            .execute("SELECT guild_id, channel_id FROM configured_channels")
+            .fetchall()
+        )
+
+    async def get_configured_channels(self):
+        return await self._read(self._get_configured_channels)
+
+    def set_turn_timer(self, guild_id, turn_timeout, warn_before):
+        return self._write(
+            """
+            INSERT OR REPLACE INTO guild_settings (guild_id, turn_timeout, warn_before)
+            VALUES (?, ?, ?)
+        """,
+            (guild_id, turn_timeout, warn_before),
+        )
+
+    def _get_turn_timers(self):
+        return {
+            guild_id: (turn_timeout, warn_before)
+            for guild_id, turn_timeout, warn_before in self._reader().execute(
+                "SELECT guild_id, turn_timeout, warn_before FROM guild_settings"
+            )
+        }
+
+    async def get_turn_timers(self):
+        return await self._read(self._get_turn_timers)
+
+    def set_ratings(self, rows):
+        # rows of (user_id, guild_id, rating, games)
+        return self._write(
+            """
+            INSERT OR REPLACE INTO ratings (user_id, guild_id, rating, games)
+            VALUES (?, ?, ?, ?)
+        """,
+            list(rows),
+        )
+
+    def _get_ratings(self):
+        return (
+            self._reader()
+            .execute("SELECT user_id, guild_id, rating, games FROM ratings")
+            .fetchall()
+        )
+
+    async def get_ratings(self):
+        return await self._read(self._get_ratings)
+
+    def record_match(
+        self,
+        match_id,
+        guild_id,
+        p1_id,
+        p2_id,
+        p1_special,
+        p2_special,
+        winner_id,
+        forfeit,
+        started_at,
+        ended_at,
+        plays,
+        seed,
+    ):
+        # plays is one (p1_first, p1_second, p2_first, p2_second) per turn
+        def won(user_id):
+            return None if winner_id is None else int(winner_id == user_id)
+
+        return self._write_many(
+            [
+                (
+                    """
+            INSERT INTO matches (match_id, guild_id, p1_id, p2_id, p1_special,
+                p2_special, turns, winner_id, forfeit, started_at, ended_at, seed)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+                    (
+                        match_id,
+                        guild_id,
+                        p1_id,
+                        p2_id,
+                        p1_special,
+                        p2_special,
+                        len(plays),
+                        winner_id,
+                        int(forfeit),
+                        started_at,
+                        ended_at,
+                        seed,
+                    ),
+                ),
+                (
+                    """
+            INSERT INTO match_players (user_id, ended_at, match_id, guild_id,
+                opponent_id, special, won)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+                    [
+                        (
+                            p1_id,
+                            ended_at,
+                            match_id,
+                            guild_id,
+                            p2_id,
+                            p1_special,
+                            won(p1_id),
+                        ),
+                        (
+                            p2_id,
+                            ended_at,
+                            match_id,
+                            guild_id,
+                            p1_id,
+                            p2_special,
+                            won(p2_id),
+                        ),
+                    ],
+                ),
+                (
+                    """
+            INSERT INTO match_plays (match_id, turn, p1_first, p1_second,
+                p2_first, p2_second)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """,
+                    [
+                        (match_id, turn, *turn_plays)
+                        for turn, turn_plays in enumerate(plays)
+                    ],
+                ),
+            ]
+        )
+
+    def roll_up_history(self, cutoff):
+        # folds per-match rows that ended before cutoff into match_rollups
+        return self._write_many(
+            [
+                (
+                    """
+            INSERT INTO match_rollups (user_id, opponent_id, special, guild_id,
+                wins, losses)
+            SELECT user_id, opponent_id, special, guild_id,
+                COALESCE(SUM(won = 1), 0), COALESCE(SUM(won = 0), 0)
+            FROM match_players WHERE ended_at < ?
+            GROUP BY user_id, opponent_id, special, guild_id
+            ON CONFLICT (user_id, opponent_id, special, guild_id) DO UPDATE SET
+            wins = COALESCE(wins, 0) + excluded.wins,
+            losses = COALESCE(losses, 0) + excluded.losses
+        """,
+                    (cutoff,),
+                ),
+                (
+                    """
+            DELETE FROM match_plays WHERE match_id IN (
+                SELECT match_id FROM matches WHERE ended_at < ?
+            )
+        """,
+                    (cutoff,),
+                ),
+                ("DELETE FROM match_players WHERE ended_at < ?", (cutoff,)),
+                ("DELETE FROM matches WHERE ended_at < ?", (cutoff,)),
+            ]
+        )
+
+    def _record(self, live_sql, rollup_sql, params):
+        conn = self._reader()
+        live = conn.execute(live_sql, params).fetchone()
+        rolled = conn.execute(rollup_sql, params).fetchone()
+        return {
+            "wins": (live[0] or 0) + (rolled[0] or 0),
+            "losses": (live[1] or 0) + (rolled[1] or 0),
+        }
+
+    def _head_to_head(self, user_id, opponent_id, guild_id):
+        return self._record(
+            """
+            SELECT SUM(won = 1), SUM(won = 0) FROM match_players
+            WHERE user_id = ? AND opponent_id = ? AND (? IS NULL OR guild_id = ?)
+        """,
+            """
+            SELECT SUM(wins), SUM(losses) FROM match_rollups
+            WHERE user_id = ? AND opponent_id = ? AND (? IS NULL OR guild_id = ?)
+        """,
+            (user_id, opponent_id, guild_id, guild_id),
+        )
+
+    async def get_head_to_head(self, user_id, opponent_id, guild_id=None):
+        return await self._read(self._head_to_head, user_id, opponent_id, guild_id)
+
+    def _special_record(self, user_id, special, guild_id):
+        return self._record(
+            """
+            SELECT SUM(won = 1), SUM(won = 0) FROM match_players
+            WHERE user_id = ? AND special = ? AND (? IS NULL OR guild_id = ?)
+        """,
+            """
+            SELECT SUM(wins), SUM(losses) FROM match_rollups
+            WHERE user_id = ? AND special = ? AND (? IS NULL OR guild_id = ?)
+        """,
+            (user_id, special, guild_id, guild_id),
+        )
+
+    async def get_special_record(self, user_id, special, guild_id=None):
+        return await self._read(self._special_record, user_id, special, guild_id)
+
+    def _recent_matches(self, user_id, limit):
+        return (
+            self._reader()
+            .execute(
+                """
+            SELECT match_id, guild_id, opponent_id, special, won, ended_at
+            FROM match_players WHERE user_id = ?
+            ORDER BY ended_at DESC LIMIT ?
+        """,
+                (user_id, limit),
+            )
+            .fetchall()
+        )
+
+    async def get_recent_matches(self, user_id, limit=10):
+        return await self._read(self._recent_matches, user_id, limit)
+
+    def save_live_match(self, *fields):
+        # fields are the columns of live_matches, in order
+        return self._write(
+            """
+            INSERT OR REPLACE INTO live_matches VALUES
+            (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """,
+            fields,
+        )
+
+    def append_match_event(self, match_id, seq, plays, state):
+        return self._write(
+            """
+            INSERT OR REPLACE INTO live_match_events VALUES (?, ?, ?, ?, ?, ?, ?)
+        """,
+            (match_id, seq, *plays, state),
+        )
+
+    def delete_live_match(self, match_id):
+        return self._write_many(
+            [
+                ("DELETE FROM live_match_events WHERE match_id = ?", (match_id,)),
+                ("DELETE FROM live_matches WHERE match_id = ?", (match_id,)),
+            ]
+        )
+
+    def _live_matches(self):
+        conn = self._reader()
+        events = {}
+        for match_id, *event in conn.execute(
+            "SELECT * FROM live_match_events ORDER BY match_id, seq"
+        ):
+            events.setdefault(match_id, []).append(tuple(event))
+        return [
+            (row, events.get(row[0], []))
+            for row in conn.execute("SELECT * FROM live_matches")
+        ]
+
+    async def get_live_matches(self):
+        # [(live_matches row, [(seq, p1_first, p1_second, p2_first,
+        # p2_second, state), ...]), ...]
+        return await self._read(self._live_matches)
 
     def close(self):
-        self.conn.close()
+        # commits everything still queued before returning
+        self._queue.put(_STOP)
+        self._writer.join()
+        self._readers.shutdown(wait=True)
+
+
+def check_rollups():
+    # A double timeout rolled up on its own, then a win for the same pairing,
+    # must still count the win; this used to leave the rollup NULL.
+    import os
+    import tempfile
+
+    async def check(db):
+        for match_id, winner_id, ended_at in ((1, None, 10.0), (2, 1, 30.0)):
+            db.record_match(
+                match_id, 5, 1, 2, 3, 4, winner_id, False, 0.0, ended_at, [], 0
+            )
+            await db.roll_up_history(ended_at + 1)
+        for user_id, opponent_id, expected in ((1, 2, (1, 0)), (2, 1, (0, 1))):
+            record = await db.get_head_to_head(user_id, opponent_id, 5)
+            if (record["wins"], record["losses"]) != expected:
+                raise AssertionError(f"Head to head {record} != {expected}")
+
+    with tempfile.TemporaryDirectory() as directory:
+        db = DatabaseHandler(os.path.join(directory, "check.db"))
+        try:
+            asyncio.run(check(db))
+        finally:
+            db.close()
+
+
+if __name__ == "__main__":
+    check_rollups()
+    print("Rolled up history keeps results around double timeouts")
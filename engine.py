@@ -0,0 +1,555 @@
+# Discord-free rules engine.
+#
+# A game state is a flat immutable tuple of small ints:
+#
+#   (half,
+#    p1cell, p1stance, p1hp, p1locked, p1special, p1special_used,
+#    p2cell, p2stance, p2hp, p2locked, p2special, p2special_used)
+#
+# stance is 0 for Heaven and 1 for Earth, locked is an index into LOCK_CARDS
+# (0 means nothing is locked), special is a play id and half is 0 or 1.
+# Plays are passed around as their card ids, which index PLAYS.
+#
+# step() resolves one turn-half with a single lookup into TRANSITIONS and
+# returns the next state plus a tuple of (code, side, play_id) events that
+# GameState turns into narration.
+
+from functools import lru_cache
+import cards
+from cards import (
+    Stance,
+    ATTACK,
+    MOVE,
+    SPECIAL,
+    counter,
+    change_stance,
+    footwork,
+    tactics,
+    low_strike,
+    high_strike,
+    balanced_strike,
+)
+
+BOARD_SIZE = 5
+STARTING_HP = 2
+
+HEAVEN = 0
+EARTH = 1
+STANCES = (Stance.HEAVEN, Stance.EARTH)
+
+PLAYS = cards.plays
+NUM_PLAYS = len(PLAYS)
+COUNTER = counter.id
+CHANGE_STANCE = change_stance.id
+
+LOCK_CARDS = (None, footwork, tactics, low_strike, high_strike, balanced_strike)
+NUM_LOCKS = len(LOCK_CARDS)
+# lock index for each card id
+_LOCK_IDS = [0] * len(cards.cards_by_id)
+for i, card in enumerate(LOCK_CARDS[1:], 1):
+    _LOCK_IDS[card.id] = i
+
+(
+    HALF,
+    P1_CELL,
+    P1_STANCE,
+    P1_HP,
+    P1_LOCKED,
+    P1_SPECIAL,
+    P1_SPECIAL_USED,
+    P2_CELL,
+    P2_STANCE,
+    P2_HP,
+    P2_LOCKED,
+    P2_SPECIAL,
+    P2_SPECIAL_USED,
+) = range(13)
+
+# event codes, each one becomes a line of the turn summary
+(
+    EV_MOVE,
+    EV_TOE_TO_TOE,
+    EV_CLASH,
+    EV_SPARKS,
+    EV_COUNTERED,
+    EV_REVERSED,
+    EV_BRACED_NOTHING,
+    EV_BRACED_WIDE,
+    EV_MISS,
+    EV_HIT,
+    EV_TECHNIQUE_STANCE,
+) = range(11)
+
+
+def play_id(play):
+    return play.id
+
+
+def lock_id(card):
+    return 0 if card is None else _LOCK_IDS[card.id]
+
+
+def stance_id(stance):
+    return HEAVEN if stance is Stance.HEAVEN else EARTH
+
+
+# per-play lookups, indexed by play id
+IS_ATTACK = tuple(bool(p.category & ATTACK) for p in PLAYS)
+IS_SPECIAL = tuple(bool(p.category & SPECIAL) for p in PLAYS)
+IS_MOVE = tuple(bool(p.category & MOVE) for p in PLAYS)
+MAGNITUDE = tuple(p.magnitude if IS_MOVE[p.id] else 0 for p in PLAYS)
+CHANGES_STANCE = tuple(bool(p.category & cards.CHANGES_STANCE) for p in PLAYS)
+CHANGES_STANCE_ON_ATTACK = tuple(
+    IS_ATTACK[i] and CHANGES_STANCE[i] for i in range(NUM_PLAYS)
+)
+HIT_MASKS = tuple(p.hits_mask if IS_ATTACK[p.id] else 0 for p in PLAYS)
+
+
+def _locks_after(play):
+    if IS_SPECIAL[play]:
+        return 0
+    card = PLAYS[play]
+    if card in footwork.actions:
+        card = footwork
+    elif card in tactics.actions:
+        card = tactics
+    return lock_id(card)
+
+
+LOCKS = tuple(_locks_after(i) for i in range(NUM_PLAYS))
+REQUIRED_STANCE = tuple(
+    stance_id(p.requires_stance) if getattr(p, "requires_stance", None) else None
+    for p in PLAYS
+)
+STANDARD_ATTACKS = tuple(
+    i for i in range(NUM_PLAYS) if IS_ATTACK[i] and not IS_SPECIAL[i]
+)
+MOVES = tuple(i for i in range(NUM_PLAYS) if IS_MOVE[i])
+
+
+def _by_name(play):
+    return PLAYS[play].name
+
+
+def _filter_legal_plays(locked, stance, special, special_used, first_card):
+    # the filtering GameState.make_play_selection_view used to do per prompt
+    attacks = [
+        p for p in STANDARD_ATTACKS if LOCKS[p] != locked and LOCKS[p] != first_card
+    ]
+    if not special_used:
+        attacks.append(special)
+    attacks = [p for p in attacks if REQUIRED_STANCE[p] in (None, stance)]
+    attacks.sort(key=_by_name)
+    moves = [p for p in MOVES if LOCKS[p] != locked and LOCKS[p] != first_card]
+    moves.sort(key=_by_name)
+    return tuple(attacks + moves)
+
+
+def legal_index(locked, stance, special, special_used, first_card):
+    index = ((locked * 2 + stance) * NUM_PLAYS + special) * 2 + special_used
+    return index * NUM_LOCKS + first_card
+
+
+# ordered legal plays for every (locked, stance, special, special used,
+# first card) combination; only special ids are valid in the special slot
+LEGAL_PLAYS = tuple(
+    (
+        _filter_legal_plays(locked, stance, special, special_used, first_card)
+        if IS_SPECIAL[special]
+        else ()
+    )
+    for locked in range(NUM_LOCKS)
+    for stance in (HEAVEN, EARTH)
+    for special in range(NUM_PLAYS)
+    for special_used in (0, 1)
+    for first_card in range(NUM_LOCKS)
+)
+
+
+def legal_plays(locked, stance, special, special_used, first_card=0):
+    # first_card is LOCKS[first play] when choosing the second play
+    return LEGAL_PLAYS[
+        legal_index(locked, stance, special, int(special_used), first_card)
+    ]
+
+
+@lru_cache(maxsize=None)
+def play_pairs(locked, stance, special, special_used):
+    # every (first, second) choice a player can make at the start of a turn
+    return tuple(
+        (first, second)
+        for first in legal_plays(locked, stance, special, special_used)
+        for second in legal_plays(
+            locked,
+            stance ^ CHANGES_STANCE[first],
+            special,
+            special_used or IS_SPECIAL[first],
+            LOCKS[first],
+        )
+    )
+
+
+def legal_pairs(state, side):
+    offset = P1_CELL if side == 0 else P2_CELL
+    (_, stance, _, locked, special, special_used) = state[offset : offset + 6]
+    return play_pairs(locked, stance, special, bool(special_used))
+
+
+def initial_state(p1_special, p2_special):
+    return (
+        0,
+        0,
+        HEAVEN,
+        STARTING_HP,
+        0,
+        p1_special,
+        False,
+        BOARD_SIZE - 1,
+        HEAVEN,
+        STARTING_HP,
+        0,
+        p2_special,
+        False,
+    )
+
+
+# bit widths of each state field, pack() fits a whole state in 31 bits
+FIELD_BITS = (1, 3, 1, 2, 3, 4, 1, 3, 1, 2, 3, 4, 1)
+
+
+def pack(state):
+    key = 0
+    for value, bits in zip(state, FIELD_BITS):
+        key = (key << bits) | int(value)
+    return key
+
+
+def unpack(key):
+    fields = []
+    for bits in reversed(FIELD_BITS):
+        fields.append(key & ((1 << bits) - 1))
+        key >>= bits
+    return tuple(reversed(fields))
+
+
+def find_midpoint(p1cell, p2cell):
+    mid = (p1cell + p2cell) / 2
+    if abs(mid - 2) <= 0.5:
+        return round(mid)
+    else:
+        return int(mid + 0.5) if mid > 2 else int(mid)
+
+
+def resolve(c1, s1, c2, s2, p1_play, p2_play):
+    # the reference branching rules for one turn-half, only used to build
+    # TRANSITIONS; returns (c1, s1, c2, s2, p1damage, p2damage, events)
+    events = []
+    d1 = d2 = 0
+
+    # movement is always resolved before attacks
+    m1 = MAGNITUDE[p1_play]
+    m2 = MAGNITUDE[p2_play]
+    p1moved = IS_MOVE[p1_play]
+    p2moved = IS_MOVE[p2_play]
+    started_in_same_cell = c1 == c2
+
+    if s1 == s2 and m1 > 0 and m2 > 0 and c1 + m1 > c2 - m2:
+        # same stance and would pass each other, meet at the midpoint
+        c1 = c2 = find_midpoint(c1, c2)
+        events.append((EV_MOVE, 0, p1_play))
+        events.append((EV_MOVE, 1, p2_play))
+    elif s1 == s2 or s1 == HEAVEN:
+        # p1 has priority
+        c1 = min(max(0, c1 + m1), c2)
+        if p1_play == CHANGE_STANCE:
+            s1 ^= 1
+        if p1moved:
+            events.append((EV_MOVE, 0, p1_play))
+        c2 = min(max(c1, c2 - m2), BOARD_SIZE - 1)
+        if p2_play == CHANGE_STANCE:
+            s2 ^= 1
+        if p2moved:
+            events.append((EV_MOVE, 1, p2_play))
+    else:
+        # p1 is in earth and p2 in heaven, so p2 has priority
+        c2 = min(max(c1, c2 - m2), BOARD_SIZE - 1)
+        if p2_play == CHANGE_STANCE:
+            s2 ^= 1
+        if p2moved:
+            events.append((EV_MOVE, 1, p2_play))
+        c1 = min(max(0, c1 + m1), c2)
+        if p1_play == CHANGE_STANCE:
+            s1 ^= 1
+        if p1moved:
+            events.append((EV_MOVE, 0, p1_play))
+
+    if c1 == c2 and not started_in_same_cell:
+        events.append((EV_TOE_TO_TOE, 0, None))
+
+    # both sides measure their attacks from their own cell towards the other
+    distance = c2 - c1
+    p1attacked = IS_ATTACK[p1_play]
+    p2attacked = IS_ATTACK[p2_play]
+    p1counter = p1_play == COUNTER
+    p2counter = p2_play == COUNTER
+    p1success = p1attacked and HIT_MASKS[p1_play] >> distance & 1
+    p2success = p2attacked and HIT_MASKS[p2_play] >> distance & 1
+
+    if p1success and p2success:
+        events.append((EV_CLASH, 0, p1_play))
+        events.append((EV_CLASH, 1, p2_play))
+        events.append((EV_SPARKS, 0, None))
+    elif p1success and p2counter:
+        events.append((EV_COUNTERED, 0, p1_play))
+        events.append((EV_REVERSED, 1, None))
+        d1 += 1
+    elif p2success and p1counter:
+        events.append((EV_COUNTERED, 1, p2_play))
+        events.append((EV_REVERSED, 0, None))
+        d2 += 1
+    elif p2counter and not p1attacked:
+        events.append((EV_BRACED_NOTHING, 1, None))
+    elif p1counter and not p2attacked:
+        events.append((EV_BRACED_NOTHING, 0, None))
+    elif p2counter and p1attacked and not p1success:
+        events.append((EV_COUNTERED, 0, p1_play))
+        events.append((EV_BRACED_WIDE, 1, None))
+    elif p1counter and p2attacked and not p2success:
+        events.append((EV_COUNTERED, 1, p2_play))
+        events.append((EV_BRACED_WIDE, 0, None))
+    elif p1success:
+        if p2attacked:
+            events.append((EV_MISS, 1, p2_play))
+        events.append((EV_HIT, 0, p1_play))
+        d2 += 1
+    elif p2success:
+        if p1attacked:
+            events.append((EV_MISS, 0, p1_play))
+        events.append((EV_HIT, 1, p2_play))
+        d1 += 1
+    else:
+        if p1attacked:
+            events.append((EV_MISS, 0, p1_play))
+        if p2attacked:
+            events.append((EV_MISS, 1, p2_play))
+
+    if CHANGES_STANCE_ON_ATTACK[p1_play]:
+        s1 ^= 1
+        events.append((EV_TECHNIQUE_STANCE, 0, None))
+    if CHANGES_STANCE_ON_ATTACK[p2_play]:
+        s2 ^= 1
+        events.append((EV_TECHNIQUE_STANCE, 1, None))
+
+    return c1, s1, c2, s2, d1, d2, tuple(events)
+
+
+def transition_index(c1, s1, c2, s2, p1_play, p2_play):
+    index = (((c1 * BOARD_SIZE + c2) * 2 + s1) * 2 + s2) * NUM_PLAYS + p1_play
+    return index * NUM_PLAYS + p2_play
+
+
+# every (cells, stances, plays) combination resolved once at import; the
+# whole table is 10000 entries and takes a few milliseconds to build
+TRANSITIONS = tuple(
+    resolve(c1, s1, c2, s2, p1_play, p2_play)
+    for c1 in range(BOARD_SIZE)
+    for c2 in range(BOARD_SIZE)
+    for s1 in (HEAVEN, EARTH)
+    for s2 in (HEAVEN, EARTH)
+    for p1_play in range(NUM_PLAYS)
+    for p2_play in range(NUM_PLAYS)
+)
+
+
+def step(state, p1_play, p2_play):
+    (half, c1, s1, hp1, l1, sp1, u1, c2, s2, hp2, l2, sp2, u2) = state
+    # transition_index, inlined
+    c1, s1, c2, s2, d1, d2, events = TRANSITIONS[
+        ((((c1 * BOARD_SIZE + c2) * 2 + s1) * 2 + s2) * NUM_PLAYS + p1_play) * NUM_PLAYS
+        + p2_play
+    ]
+
+    if IS_SPECIAL[p1_play]:
+        u1 = True
+    if IS_SPECIAL[p2_play]:
+        u2 = True
+
+    # the card played in the second half is locked for the next turn
+    if half:
+        l1 = LOCKS[p1_play]
+        l2 = LOCKS[p2_play]
+
+    return (
+        half ^ 1,
+        c1,
+        s1,
+        hp1 - d1,
+        l1,
+        sp1,
+        u1,
+        c2,
+        s2,
+        hp2 - d2,
+        l2,
+        sp2,
+        u2,
+    ), events
+
+
+def winner(state):
+    # 0 while the duel is still going, otherwise the winning side (1 or 2)
+    if state[P1_HP] <= 0:
+        return 2
+    if state[P2_HP] <= 0:
+        return 1
+    return 0
+
+
+def baseline_resolve(c1, s1, c2, s2, p1_play, p2_play):
+    # A line-by-line port of the original GameState.resolve_movement,
+    # does_attack_succeed and resolve_plays, working on the card objects the
+    # way they did, kept to check the table against. The one change is the
+    # Change Stance fix: p2's stance used to be flipped from p1's.
+    p1play = PLAYS[p1_play]
+    p2play = PLAYS[p2_play]
+    events = []
+    d1 = d2 = 0
+
+    p1move = p1play if p1play in cards.move_actions else None
+    p2move = p2play if p2play in cards.move_actions else None
+    p1magnitude = p1move.magnitude if p1move else 0
+    p2magnitude = p2move.magnitude if p2move else 0
+    p1change_stance = p1play is change_stance
+    p2change_stance = p2play is change_stance
+    players_started_in_same_cell = c1 == c2
+
+    def clamp(index, min_val, max_val):
+        return min((max(min_val, index)), max_val)
+
+    if (
+        s1 == s2
+        and p1magnitude > 0
+        and p2magnitude > 0
+        and (c1 + p1magnitude > c2 - p2magnitude)
+    ):
+        mid = (c1 + c2) / 2
+        if abs(mid - 2) <= 0.5:
+            midpoint = round(mid)
+        else:
+            midpoint = int(mid + 0.5) if mid > 2 else int(mid)
+        c1 = c2 = midpoint
+        events.append((EV_MOVE, 0, p1_play))
+        events.append((EV_MOVE, 1, p2_play))
+    elif s1 == s2 or s1 == HEAVEN:
+        c1 = clamp(c1 + p1magnitude, 0, c2)
+        if p1change_stance:
+            s1 = HEAVEN if s1 == EARTH else EARTH
+        if p1move:
+            events.append((EV_MOVE, 0, p1_play))
+        c2 = clamp(c2 - p2magnitude, c1, BOARD_SIZE - 1)
+        if p2change_stance:
+            s2 = HEAVEN if s2 == EARTH else EARTH
+        if p2move:
+            events.append((EV_MOVE, 1, p2_play))
+    elif s1 == EARTH:
+        c2 = clamp(c2 - p2magnitude, c1, BOARD_SIZE - 1)
+        if p2change_stance:
+            s2 = HEAVEN if s2 == EARTH else EARTH
+        if p2move:
+            events.append((EV_MOVE, 1, p2_play))
+        c1 = clamp(c1 + p1magnitude, 0, c2)
+        if p1change_stance:
+            s1 = HEAVEN if s1 == EARTH else EARTH
+        if p1move:
+            events.append((EV_MOVE, 0, p1_play))
+
+    if c1 == c2 and not players_started_in_same_cell:
+        events.append((EV_TOE_TO_TOE, 0, None))
+
+    p1attacked = p1play in cards.attack_cards
+    p2attacked = p2play in cards.attack_cards
+    p1counter = p1play is counter
+    p2counter = p2play is counter
+    p1success = p1attacked and c2 in [c + c1 for c in p1play.hits_cells]
+    p2success = p2attacked and c1 in [c2 - c for c in p2play.hits_cells]
+
+    if p1success and p2success:
+        events.append((EV_CLASH, 0, p1_play))
+        events.append((EV_CLASH, 1, p2_play))
+        events.append((EV_SPARKS, 0, None))
+    elif p1success and p2counter:
+        events.append((EV_COUNTERED, 0, p1_play))
+        events.append((EV_REVERSED, 1, None))
+        d1 += 1
+    elif p2success and p1counter:
+        events.append((EV_COUNTERED, 1, p2_play))
+        events.append((EV_REVERSED, 0, None))
+        d2 += 1
+    elif p2counter and not p1attacked:
+        events.append((EV_BRACED_NOTHING, 1, None))
+    elif p1counter and not p2attacked:
+        events.append((EV_BRACED_NOTHING, 0, None))
+    elif p2counter and p1attacked and not p1success:
+        events.append((EV_COUNTERED, 0, p1_play))
+        events.append((EV_BRACED_WIDE, 1, None))
+    elif p1counter and p2attacked and not p2success:
+        events.append((EV_COUNTERED, 1, p2_play))
+        events.append((EV_BRACED_WIDE, 0, None))
+    elif p1success:
+        if p2attacked:
+            events.append((EV_MISS, 1, p2_play))
+        events.append((EV_HIT, 0, p1_play))
+        d2 += 1
+    elif p2success:
+        if p1attacked:
+            events.append((EV_MISS, 0, p1_play))
+        events.append((EV_HIT, 1, p2_play))
+        d1 += 1
+    elif not p1success and not p2success:
+        if p1attacked:
+            events.append((EV_MISS, 0, p1_play))
+        if p2attacked:
+            events.append((EV_MISS, 1, p2_play))
+
+    if p1attacked and p1play.category & cards.CHANGES_STANCE:
+        s1 = HEAVEN if s1 == EARTH else EARTH
+        events.append((EV_TECHNIQUE_STANCE, 0, None))
+    if p2attacked and p2play.category & cards.CHANGES_STANCE:
+        s2 = HEAVEN if s2 == EARTH else EARTH
+        events.append((EV_TECHNIQUE_STANCE, 1, None))
+
+    return c1, s1, c2, s2, d1, d2, tuple(events)
+
+
+def check_transitions():
+    # Compares every reachable entry of the table (p1 never right of p2)
+    # with the original branching rules, see baseline_resolve.
+    for c1 in range(BOARD_SIZE):
+        for c2 in range(BOARD_SIZE):
+            for s1 in (HEAVEN, EARTH):
+                for s2 in (HEAVEN, EARTH):
+                    for p1_play in range(NUM_PLAYS):
+                        for p2_play in range(NUM_PLAYS):
+                            i = transition_index(c1, s1, c2, s2, p1_play, p2_play)
+                            if c1 > c2:
+                                continue
+                            expected = baseline_resolve(
+                                c1, s1, c2, s2, p1_play, p2_play
+                            )
+                            if TRANSITIONS[i] != expected:
+                                raise AssertionError(
+                                    f"Transition mismatch at {i}: {TRANSITIONS[i]} != {expected}"
+                                )
+
+
+if __name__ == "__main__":
+    import timeit
+
+    check_transitions()
+    print("Every reachable transition matches the original branching rules")
+    state = initial_state(0, 1)
+    n = 1_000_000
+    seconds = timeit.timeit(lambda: step(state, 6, 8), number=n)
+    print(f"step: {n / seconds:,.0f} turn-halves/s")
+    seconds = timeit.timeit(lambda: resolve(0, 0, 4, 0, 6, 8), number=n)
+    print(f"resolve: {n / seconds:,.0f} turn-halves/s")
@@ -1,34 +1,91 @@
+import os
 import random
 import asyncio
+import time
+from uuid import uuid4
 import discord
 from player import Player
 from dataclasses import dataclass
 from typing import Optional
-from awaitable_view import AwaitableView
-from itertools import chain
-from cards import (
-    special_attack_cards,
-    counter,
-    Stance,
-    attack_cards,
-    move_cards,
-    move_actions,
-    tactics,
-    footwork,
-    special_attack_cards,
-    change_stance,
+import prompts
+from timers import wheel
+from outbound import outbox, PROMPT
+import tracing
+import metrics
+from ai import MonteCarloAI
+from cards import special_attack_cards, Stance, SPECIAL
+import engine
+
+# which card message each play event uses
+PLAY_EVENT_MESSAGES = {
+    engine.EV_MOVE: "msg",
+    engine.EV_CLASH: "clash_msg",
+    engine.EV_COUNTERED: "counter_msg",
+    engine.EV_MISS: "miss_msg",
+    engine.EV_HIT: "success_msg",
+}
+
+# (label, play id) for each button of every legal play set in engine.LEGAL_PLAYS
+BUTTON_SPECS = tuple(
+    tuple((engine.PLAYS[p].button_text, p) for p in legal)
+    for legal in engine.LEGAL_PLAYS
 )
 
+# how players pick their plays: two selects in one message that is reused
+# every turn, or the original button prompt per play
+COMBINED_PROMPTS = "combined"
+BUTTON_PROMPTS = "buttons"
+PROMPT_MODE = os.environ.get("DUELBOT_PROMPT_MODE", COMBINED_PROMPTS)
+
+# seconds a player gets to press a button, unless the guild sets its own
+PROMPT_TIMEOUT = 800
+# a duel that hasn't started a new turn in this long after its turn clock
+# could have run out is treated as stuck and called off
+IDLE_GRACE = 60
+
+EVENT_MESSAGES = {
+    engine.EV_TOE_TO_TOE: "The two warriors come toe to toe!",
+    engine.EV_SPARKS: "Sparks fly as the blades clash! No damage!",
+    engine.EV_REVERSED: "-- but {a} reverses the blow with a perfect counter!",
+    engine.EV_BRACED_NOTHING: "{a} braces to counter an attack that never comes!",
+    engine.EV_BRACED_WIDE: "-- {a} is braced to counter, but the attack goes wide!",
+    engine.EV_TECHNIQUE_STANCE: "{a}'s technique leaves them in {other_stance} stance.",
+}
+
+# every narration template, keyed by (event code, play id or None)
+NARRATION_TEMPLATES = {
+    **{(code, None): template for code, template in EVENT_MESSAGES.items()},
+    **{
+        (code, play.id): getattr(play, attr)
+        for play in engine.PLAYS
+        for code, attr in PLAY_EVENT_MESSAGES.items()
+        if getattr(play, attr, None) is not None
+    },
+}
+
+
+@dataclass
+class SavedMember:
+    # stands in for a discord.Member when a duel is rebuilt from storage
+    id: int
+    display_name: str
+
+    @property
+    def mention(self):
+        return f"<@{self.id}>"
+
 
 @dataclass
 class GameState:
     channel: discord.TextChannel
     p1: Player
     p2: Player
-    winner_future = asyncio.Future()
     turn_summary: list[str]
     board_size: int = 5
     in_progress: bool = True
+    winner: Optional[Player] = None
+    loser: Optional[Player] = None
+    forfeit: bool = False
 
     def __init__(
         self,
@@ -36,31 +93,69 @@ class GameState:
         player2: discord.Member,
         channel: discord.TextChannel,
         p1_challenge_interaction: discord.Interaction,
-        p2_challenge_interaction: discord.Interaction,
+        p2_challenge_interaction: Optional[discord.Interaction],
         p1_emoji: Optional[str] = None,
         p2_emoji: Optional[str] = None,
+        p2_ai: Optional[MonteCarloAI] = None,
+        seed: Optional[int] = None,
+        journal=None,
+        turn_timeout: int = PROMPT_TIMEOUT,
+        warn_before: Optional[int] = None,
+        prompt_mode: str = PROMPT_MODE,
     ):
         self.channel = channel
         self.turn_summary = []
-        p1_special = random.choice(special_attack_cards)
-        p2_special = random.choice([s for s in special_attack_cards if s != p1_special])
+        self.turn_timeout = turn_timeout
+        self.prompt_mode = prompt_mode
+        # user_id -> the combined prompt message being reused
+        self.prompt_messages = {}
+        # Discord calls made by this duel, see api
+        self.api_calls = 0
+        # seconds before the turn clock runs out to warn a player, if set
+        self.warn_before = warn_before
+        # the task running the duel and its idle timer, see keep_alive
+        self.task = None
+        self.idle_timer = None
+        self.reaped = False
+        # held while the duel's state changes
+        self.lock = asyncio.Lock()
+        # gets every resolved turn-half so the duel can be resumed after a
+        # restart, see journal.py
+        self.journal = journal
+        # set when restored between the two halves of a turn
+        self.interrupted = False
+        self.trace = tracing.Trace()
+        self.match_id = uuid4().int >> 65
+        # all of the match's randomness comes from here, so the seed is
+        # enough to deal the same specials and emojis again
+        self.seed = seed if seed is not None else random.getrandbits(63)
+        self.rng = random.Random(self.seed)
+        self.started_at = time.time()
+        self.ended_at = None
+        # (p1 first, p1 second, p2 first, p2 second) play ids for each turn
+        self.play_log = []
+        p1_special = self.rng.choice(special_attack_cards)
+        p2_special = self.rng.choice(
+            [s for s in special_attack_cards if s != p1_special]
+        )
 
         emojiList = ["🐻", "🐯", "🐲", "🦅", "🐍", "🦉", "🐗", "🐸", "🐺"]
         p1_emoji = (
             p1_emoji
             if p1_emoji is not None
-            else random.choice(["🐻", "🐯", "🐲", "🦅", "🐍", "🦉", "🐗", "🐸", "🐺"])
+            else self.rng.choice(["🐻", "🐯", "🐲", "🦅", "🐍", "🦉", "🐗", "🐸", "🐺"])
         )
         p2_emoji = (
             p2_emoji
             if p2_emoji is not None and p2_emoji != p1_emoji
-            else random.choice([e for e in emojiList if e != p1_emoji])
+            else self.rng.choice([e for e in emojiList if e != p1_emoji])
         )
 
         self.p1 = Player(
             cell=0,
             special=p1_special,
             name=player1.display_name,
+            user_id=player1.id,
             mention=player1.mention,
             emoji=p1_emoji,
             initial_challenge=p1_challenge_interaction,
@@ -70,18 +165,49 @@ class GameState:
             cell=self.board_size - 1,
             special=p2_special,
             name=player2.display_name,
+            user_id=player2.id,
             mention=player2.mention,
             emoji=p2_emoji,
             initial_challenge=p2_challenge_interaction,
+            ai=p2_ai,
         )
+        # narration for each side, with the names already filled in
+        self.narration = (
+            self.bind_narration(self.p1, self.p2),
+            self.bind_narration(self.p2, self.p1),
+        )
+        # packed engine state -> board and status lines, see render_board
+        self.rendered = {}
 
     async def run_until_end(self):
-        print(f"Started duel between {self.p1.name} and {self.p2.name}")
+        self.trace.record(tracing.STARTED, self.seed)
         finished = False
-        is_turn_one = True
-        while not finished:
-            finished = await self.start_turn(is_turn_one)
-            is_turn_one = False
+        is_turn_one = not self.play_log
+        if is_turn_one and self.journal is not None:
+            self.journal.started(self)
+        self.task = asyncio.current_task()
+        try:
+            if self.interrupted:
+                self.interrupted = False
+                finished = await self.resolve_second_half()
+            while not finished:
+                self.keep_alive()
+                finished = await self.start_turn(is_turn_one)
+                is_turn_one = False
+        finally:
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+
+    def keep_alive(self):
+        # a turn can wait on a reconnect and two prompts
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        self.idle_timer = wheel.schedule(self.turn_timeout * 3 + IDLE_GRACE, self.reap)
+
+    def reap(self):
+        self.trace.record(tracing.REAPED)
+        self.reaped = True
+        self.task.cancel()
 
     def symbol_for_cell(self, index):
         if index == self.p1.cell and index == self.p2.cell:
@@ -93,6 +219,18 @@ class GameState:
         else:
             return "\_"
 
+    def render_board(self):
+        # the board and both status lines only change with the engine state
+        key = engine.pack(self.engine_state(True))
+        rendered = self.rendered.get(key)
+        if rendered is None:
+            board = " ".join([self.symbol_for_cell(i) for i in range(self.board_size)])
+            rendered = self.rendered[key] = (
+                f"{board}\n\n"
+                f"{self.p1.make_state_string()}\n{self.p2.make_state_string()}"
+            )
+        return rendered
+
     async def start_turn(self, is_turn_one=False):
 
         # post game state and board, then clear summary
@@ -102,11 +240,9 @@ class GameState:
         if len(self.turn_summary):
             msg += "\n" + "\n".join(self.turn_summary) + "\n\n"
         self.turn_summary.clear()
-        board = " ".join([self.symbol_for_cell(i) for i in range(self.board_size)])
-        msg += f"{board}\n\n"
-        msg += self.p1.make_state_string() + "\n"
-        msg += self.p2.make_state_string()
-        await self.channel.send(msg)
+        msg += self.render_board()
+        # not awaited, so the prompts below don't queue behind the board
+        self.post(msg)
 
         self.p1.clear_plays()
         self.p2.clear_plays()
@@ -138,16 +274,28 @@ class GameState:
             await self.end_game(self.p1, self.p2, forfeit=True)
             return True
 
-        print(f"p1 is playing  {[c.name for c in self.p1.chosen_plays]}")
-        print(f"p2 is playing  {[c.name for c in self.p2.chosen_plays]}")
+        async with self.lock:
+            self.play_log.append(
+                tuple(p.id for p in self.p1.chosen_plays + self.p2.chosen_plays)
+            )
+            self.trace.record(
+                tracing.CHOSEN, len(self.play_log) - 1, *self.play_log[-1]
+            )
 
-        self.resolve_plays(True)
+            self.resolve_plays(True)
 
-        (winner, loser) = self.check_for_game_end()
-        if winner:
-            await self.end_game(winner, loser)
-            return True
+            (winner, loser) = self.check_for_game_end()
+            if winner:
+                await self.end_game(winner, loser)
+                return True
 
+            return await self._resolve_second_half()
+
+    async def resolve_second_half(self):
+        async with self.lock:
+            return await self._resolve_second_half()
+
+    async def _resolve_second_half(self):
         self.resolve_plays(False)
 
         (winner, loser) = self.check_for_game_end()
@@ -157,163 +305,107 @@ class GameState:
 
     async def end_game(self, winner, loser, forfeit=False):
         # winner is only none if double timeout
-        # send summary and win message
+        # record the result first so a failed send can't lose it
+        self.in_progress = False
+        self.winner = winner
+        self.loser = loser
+        self.forfeit = forfeit
+        self.ended_at = time.time()
+        if self.journal is not None:
+            self.journal.finished(self)
+        self.trace.record(
+            tracing.FINISHED,
+            None if winner is None else 1 if winner is self.p1 else 2,
+            forfeit,
+            len(self.play_log),
+            self.api_calls,
+        )
 
+        # send summary and win message
         if forfeit and winner is None:
-            await self.channel.send("u both timed out gg go home")
+            msg = "u both timed out gg go home"
         elif forfeit:
-            await self.channel.send(
-                f"gg {winner.mention} wins bc their opp fell aslp clapclap"
-            )
+            msg = f"gg {winner.mention} wins bc their opp fell aslp clapclap"
         else:
             msg = "\n".join(self.turn_summary)
             msg += "\n\n"
-            msg += (
-                " ".join([self.symbol_for_cell(i) for i in range(self.board_size)])
-                + "\n\n"
-            )
-            msg += self.p1.make_state_string() + "\n"
-            msg += self.p2.make_state_string() + "\n"
+            msg += self.render_board() + "\n"
             msg += f"gg {winner.mention} wins gj clapclap"
-            await self.channel.send(msg)
-        self.in_progress = False
-        self.winner_future.set_result((winner, loser))
+        try:
+            await self.post(msg)
+        except discord.HTTPException:
+            # already logged by outbound
+            pass
+        for message in self.prompt_messages.values():
+            try:
+                await self.api(message.delete())
+            except discord.HTTPException:
+                pass
+        self.prompt_messages.clear()
 
     def resolve_plays(self, is_first_half_of_turn):
+        start = metrics.clock()
         chosen_play_index = 0 if is_first_half_of_turn else 1
         p1play = self.p1.chosen_plays[chosen_play_index]
         p2play = self.p2.chosen_plays[chosen_play_index]
 
-        print(f"Resolving {p1play.name} and {p2play.name}")
-
-        self.resolve_movement(p1play, p2play)
-
-        # resolve attacks
-        p1attacked = p1play in attack_cards
-        p2attacked = p2play in attack_cards
-        p1counter = p1play is counter
-        p2counter = p2play is counter
-        p1success = p1attacked and self.does_attack_succeed(True, p1play)
-        p2success = p2attacked and self.does_attack_succeed(False, p2play)
-
-        print(
-            f"p1attacked: {p1attacked}, p2attacked: {p2attacked}, p1play: {p1play.name}, p2play: {p2play.name}, p1counter: {p1counter}, p2counter: {p2counter}, p1success: {p1success}, p2success: {p2success}"
+        state, events = engine.step(
+            self.engine_state(is_first_half_of_turn),
+            engine.play_id(p1play),
+            engine.play_id(p2play),
         )
-
-        # clash
-        if p1success and p2success:
-            self.turn_summary.append(self.tp(p1play.clash_msg, True))
-            self.turn_summary.append(self.tp(p2play.clash_msg, False))
-            self.turn_summary.append("Sparks fly as the blades clash! No damage!")
-        # counter by 2
-        elif p1success and p2counter:
-            self.turn_summary.append(self.tp(p1play.counter_msg, True))
-            self.turn_summary.append(
-                f"-- but {self.p2.name} reverses the blow with a perfect counter!"
-            )
-            self.p1.take_hit()
-        # counter by 1
-        elif p2success and p1counter:
-            self.turn_summary.append(self.tp(p2play.counter_msg, False))
-            self.turn_summary.append(
-                f"-- but {self.p1.name} reverses the blow with a perfect counter!"
-            )
-            self.p2.take_hit()
-        elif p2counter and not p1attacked:
-            self.turn_summary.append(
-                f"{self.p2.name} braces to counter an attack that never comes!"
-            )
-        elif p1counter and not p2attacked:
-            self.turn_summary.append(
-                f"{self.p1.name} braces to counter an attack that never comes!"
-            )
-        elif p2counter and p1attacked and not p1success:
-            self.turn_summary.append(self.tp(p1play.counter_msg, True))
-            self.turn_summary.append(
-                f"-- {self.p2.name} is braced to counter, but the attack goes wide!"
-            )
-        elif p1counter and p2attacked and not p2success:
-            self.turn_summary.append(self.tp(p2play.counter_msg, False))
-            self.turn_summary.append(
-                f"-- {self.p1.name} is braced to counter, but the attack goes wide!"
-            )
-        # p1 hit
-        elif p1success:
-            if p2attacked:
-                self.turn_summary.append(self.tp(p2play.miss_msg, False))
-            self.turn_summary.append(self.tp(p1play.success_msg, True))
-            self.p2.take_hit()
-        # p2 hit
-        elif p2success:
-            if p1attacked:
-                self.turn_summary.append(self.tp(p1play.miss_msg, True))
-            self.turn_summary.append(self.tp(p2play.success_msg, False))
-            self.p1.take_hit()
-        # if nobody hit, still need to print misses
-        elif not p1success and not p2success:
-            if p1attacked:
-                self.turn_summary.append(self.tp(p1play.miss_msg, True))
-            if p2attacked:
-                self.turn_summary.append(self.tp(p2play.miss_msg, False))
-
-        # special used handling isn't necessary because it's done at point of move choice
-
-        if p1attacked and p1play.changes_stance:
-            self.p1.stance = (
-                Stance.HEAVEN if self.p1.stance is Stance.EARTH else Stance.EARTH
-            )
-            print(f"p1 stance is now {self.p1.stance} due to a stance change attack")
-            self.turn_summary.append(
-                f"{self.p1.name}'s technique leaves them in {self.p1.stance.value} stance."
-            )
-        if p2attacked and p2play.changes_stance:
-            self.p2.stance = (
-                Stance.HEAVEN if self.p2.stance is Stance.EARTH else Stance.EARTH
-            )
-            print(f"p2 stance is now {self.p2.stance} due to a stance change attack")
-            self.turn_summary.append(
-                f"{self.p2.name}'s technique leaves them in {self.p2.stance.value} stance."
-            )
-
-        if not is_first_half_of_turn:
-            p1card = self.get_card_played(self.p1, False)
-            p2card = self.get_card_played(self.p2, False)
-            self.p1.lock(p1card if p1card not in special_attack_cards else None)
-            self.p2.lock(p2card if p2card not in special_attack_cards else None)
-
-    def tp(self, template_string, is_p1):
-        a = self.p1 if is_p1 else self.p2
-        b = self.p2 if is_p1 else self.p1
-        other_stance = Stance.EARTH if a.stance is Stance.HEAVEN else Stance.HEAVEN
+        self.trace.record(tracing.RESOLVED, p1play.id, p2play.id, state, events)
+        # narration is rendered against the pre-step players, so that
+        # {other_stance} is the stance a player is switching into
+        for event in events:
+            self.turn_summary.append(self.describe_event(event))
+        self.apply_engine_state(state)
+        if self.journal is not None:
+            self.journal.half_resolved(self, state)
+        metrics.TURN_RESOLUTION.since(start)
+
+    def engine_state(self, is_first_half_of_turn):
         return (
-            template_string.replace("{a}", a.name)
-            .replace("{b}", b.name)
-            .replace("{other_stance}", other_stance.value)
+            0 if is_first_half_of_turn else 1,
+            *self.player_fields(self.p1),
+            *self.player_fields(self.p2),
         )
 
-    def does_attack_succeed(self, is_p1, card):
-        print(
-            f"Checking if {'p1' if is_p1 else 'p2'} hits successfully with {card.name}"
+    def player_fields(self, player):
+        return (
+            player.cell,
+            engine.stance_id(player.stance),
+            player.hp,
+            engine.lock_id(player.locked),
+            engine.play_id(player.special),
+            player.special_used,
         )
-        if is_p1:
-            hit_cells = [c + self.p1.cell for c in card.hits_cells]
-            print(
-                f"p1 in {self.p1.cell} used {card.name} hitting {hit_cells} which {'does' if self.p2.cell in hit_cells else 'does not'} hit {self.p2.name} in {self.p2.cell}"
-            )
-            return self.p2.cell in hit_cells
-        else:
-            hit_cells = [self.p2.cell - c for c in card.hits_cells]
-            print(
-                f"p2 in {self.p2.cell} used {card.name} hitting {hit_cells} which {'does' if self.p1.cell in hit_cells else 'does not'} hit {self.p1.name} in {self.p1.cell}"
-            )
-            return self.p1.cell in hit_cells
 
-    def clamp(self, index, min_val, max_val):
-        # print(f"Clamping index {index} between {min_val} and {max_val}")
-        return min((max(min_val, index)), max_val)
+    def apply_engine_state(self, state):
+        for player, offset in ((self.p1, engine.P1_CELL), (self.p2, engine.P2_CELL)):
+            (cell, stance, hp, locked, _, special_used) = state[offset : offset + 6]
+            player.cell = cell
+            player.stance = engine.STANCES[stance]
+            player.hp = hp
+            player.locked = engine.LOCK_CARDS[locked]
+            player.special_used = special_used
+
+    def describe_event(self, event):
+        code, side, play_id = event
+        player = self.p1 if side == 0 else self.p2
+        return self.narration[player is self.p2][
+            code, play_id, engine.stance_id(player.stance)
+        ]
 
-    def moves_would_pass(self, p1vector, p2vector):
-        return self.p1.cell + p1vector > self.p2.cell - p2vector
+    def bind_narration(self, a, b):
+        # (event code, play id, stance id of a) -> narration line
+        return {
+            (code, play_id, stance): template.replace("{a}", a.name)
+            .replace("{b}", b.name)
+            .replace("{other_stance}", engine.STANCES[1 - stance].value)
+            for (code, play_id), template in NARRATION_TEMPLATES.items()
+            for stance in (engine.HEAVEN, engine.EARTH)
+        }
 
     def check_for_game_end(self):
         # winner, loser
@@ -324,196 +416,264 @@ class GameState:
         else:
             return (None, None)
 
-    def find_midpoint(self):
-        mid = (self.p1.cell + self.p2.cell) / 2
-        if abs(mid - 2) <= 0.5:
-            return round(mid)
-        else:
-            return int(mid + 0.5) if mid > 2 else int(mid)
-
-    def append_movement_to_summary(self, player, play):
-        if play:
-            is_p1 = player is self.p1
-            self.turn_summary.append(self.tp(play.msg, is_p1))
-
-    def resolve_movement(self, p1play, p2play):
-        p1move = p1play if p1play in move_actions else None
-        p2move = p2play if p2play in move_actions else None
-        p1magnitude = p1move.magnitude if p1move else 0
-        p2magnitude = p2move.magnitude if p2move else 0
-        p1change_stance = p1play is change_stance
-        p2change_stance = p2play is change_stance
-        players_started_in_same_cell = self.p1.cell == self.p2.cell
-
-        print(
-            f"Resolving movement: p1: {p1move.name if p1move else None}, p2: {p2move.name if p2move else None}, p1magnitude: {p1magnitude}, p2magnitude: {p2magnitude}"
+    def legal_specs(self, player, first=None):
+        # (label, play id) for each legal first play, or for each legal
+        # second play once first has been chosen
+        stance = engine.stance_id(player.stance)
+        special_used = int(player.special_used)
+        first_card = 0
+        if first is not None:
+            stance ^= engine.CHANGES_STANCE[first]
+            special_used |= engine.IS_SPECIAL[first]
+            first_card = engine.LOCKS[first]
+        return BUTTON_SPECS[
+            engine.legal_index(
+                engine.lock_id(player.locked),
+                stance,
+                engine.play_id(player.special),
+                special_used,
+                first_card,
+            )
+        ]
+
+    def make_play_selection_view(self, player, step):
+        first = engine.play_id(player.chosen_plays[0]) if player.chosen_plays else None
+        buttons_with_values = []
+        for label, play in self.legal_specs(player, first):
+            button = discord.ui.Button(style=discord.ButtonStyle.primary, label=label)
+            buttons_with_values.append((button, play))
+        return prompts.make_view(
+            self.match_id, len(self.play_log), step, buttons_with_values
         )
 
-        # if same stance and would overlap, set to midpoint
-        if (
-            self.p1.stance == self.p2.stance
-            and p1magnitude > 0
-            and p2magnitude > 0
-            and self.moves_would_pass(p1magnitude, p2magnitude)
-        ):
-            midpoint = self.find_midpoint()
-            self.p1.cell = midpoint
-            self.p2.cell = midpoint
-            self.append_movement_to_summary(self.p1, p1move)
-            self.append_movement_to_summary(self.p2, p2move)
-        elif self.p1.stance == self.p2.stance or self.p1.stance == Stance.HEAVEN:
-            # if same stance but no overlap, OR p1 is heaven, resolve p1 first
-            self.p1.cell = self.clamp(self.p1.cell + p1magnitude, 0, self.p2.cell)
-            if p1change_stance:
-                self.p1.stance = (
-                    Stance.HEAVEN if self.p1.stance is Stance.EARTH else Stance.EARTH
-                )
-                print(
-                    f"p1 stance is now {self.p1.stance} due to a change stance action"
-                )
-            self.append_movement_to_summary(self.p1, p1move)
-            self.p2.cell = self.clamp(
-                self.p2.cell - p2magnitude, self.p1.cell, self.board_size - 1
-            )
-            if p2change_stance:
-                self.p2.stance = (
-                    Stance.HEAVEN if self.p1.stance is Stance.EARTH else Stance.EARTH
-                )
-                print(
-                    f"p2 stance is now {self.p2.stance} due to a change stance action"
+    def make_combined_view(self, player, first=None):
+        # both plays in one prompt; the second menu is filled in once the
+        # first play is picked
+        first_menu = discord.ui.Select(
+            placeholder="First move",
+            options=[
+                discord.SelectOption(
+                    label=label, value=str(play), default=play == first
                 )
-            self.append_movement_to_summary(self.p2, p2move)
-        elif self.p1.stance == Stance.EARTH:
-            self.p2.cell = self.clamp(
-                self.p2.cell - p2magnitude, self.p1.cell, self.board_size - 1
+                for label, play in self.legal_specs(player)
+            ],
+        )
+        if first is None:
+            second_menu = discord.ui.Select(
+                placeholder="Second move",
+                options=[discord.SelectOption(label="Pick a first move", value="-1")],
+                disabled=True,
             )
-            if p2change_stance:
-                self.p2.stance = (
-                    Stance.HEAVEN if self.p1.stance is Stance.EARTH else Stance.EARTH
-                )
-            self.append_movement_to_summary(self.p2, p2move)
-            self.p1.cell = self.clamp(self.p1.cell + p1magnitude, 0, self.p2.cell)
-            if p1change_stance:
-                self.p1.stance = (
-                    Stance.HEAVEN if self.p1.stance is Stance.EARTH else Stance.EARTH
-                )
-            self.append_movement_to_summary(self.p1, p1move)
-
-        if self.p1.cell == self.p2.cell and not players_started_in_same_cell:
-            self.turn_summary.append(f"The two warriors come toe to toe!")
-
-    def get_card_played(self, player, is_first):
-        index = 0 if is_first else 1
-        if len(player.chosen_plays) < index + 1:
-            return None
-        play = player.chosen_plays[index]
-        if play in attack_cards or play is counter:
-            return play
         else:
-            # is move
-            if play in footwork.actions:
-                return footwork
-            elif play in tactics.actions:
-                return tactics
-            else:
-                print(f"Unknown card played first for player {player.name}")
-                return None
-
-    def make_play_selection_view(self, player, will_switch_stance):
-
-        first_card_played = self.get_card_played(player, True)
-
-        playerStance = player.stance
-        if will_switch_stance:
-            playerStance = (
-                Stance.HEAVEN if playerStance == Stance.EARTH else Stance.EARTH
+            second_menu = discord.ui.Select(
+                placeholder="Second move",
+                options=[
+                    discord.SelectOption(label=label, value=str(play))
+                    for label, play in self.legal_specs(player, first)
+                ],
             )
-
-        # Get all standard attack cards - locked card + unused special card - first play
-        available_attack_cards = [
-            c
-            for c in attack_cards
-            if player.locked is not c
-            and not c.is_special
-            and c is not first_card_played
-        ]
-        if not player.special_used:
-            available_attack_cards.append(player.special)
-        # filter out off-stance cards
-        available_attack_cards = [
-            c
-            for c in available_attack_cards
-            if c.requires_stance == playerStance or c.requires_stance == None
-        ]
-        available_attack_cards.sort()
-
-        # gotta retroactively determine the move card played to prevent it showing again
-        # first_move_card_played = (
-        #     next(c for c in move_cards if player.chosen_plays[0] in c.actions)
-        #     if len(player.chosen_plays) > 0 and player.chosen_plays[0] in move_actions
-        #     else None
-        # )
-
-        available_move_cards = [
-            c
-            for c in move_cards
-            if player.locked is not c and c is not first_card_played
-        ]
-        available_move_actions = list(
-            chain(*[move.actions for move in available_move_cards])
+        return prompts.make_view(
+            self.match_id,
+            len(self.play_log),
+            prompts.COMBINED,
+            [(first_menu, prompts.FIRST), (second_menu, prompts.SECOND)],
         )
-        available_move_actions.sort()
-
-        available_plays = available_attack_cards + available_move_actions
 
-        buttons_with_values = []
-        for play in available_plays:
-            button = discord.ui.Button(
-                style=discord.ButtonStyle.primary, label=play.button_text
+    async def api(self, call, priority=PROMPT):
+        # every Discord call a duel makes goes through here to be counted
+        # and paced; interaction responses pass priority=None
+        self.api_calls += 1
+        return await outbox.run(call, priority)
+
+    def post(self, content, view=None):
+        # queues a channel message, see outbound; await it for the Message
+        self.api_calls += 1
+        return outbox.post(self.channel, content, view)
+
+    async def wait_for_click(self, player, step, timeout=None):
+        # the clicked value and its interaction, or (None, None) on timeout
+        if timeout is None:
+            timeout = self.turn_timeout
+        if timeout <= 0:
+            return None, None
+        try:
+            return await prompts.router.wait(
+                self.match_id,
+                player.user_id,
+                len(self.play_log),
+                step,
+                timeout,
+                self.warn_before,
+                lambda: asyncio.ensure_future(self.warn(player)),
+            )
+        except TimeoutError:
+            return None, None
+
+    async def warn(self, player):
+        interaction = player.initial_challenge
+        if interaction is None:
+            await self.post(
+                f"{player.mention}, {self.warn_before} seconds left to continue!"
+            )
+        else:
+            await self.api(
+                interaction.followup.send(
+                    f"{self.warn_before} seconds left to choose!", ephemeral=True
+                )
             )
-            buttons_with_values.append((button, play))
-        view = AwaitableView(buttons_with_values, 800)
-        return view
+
+    async def wait_for_play(self, player, step):
+        play_id, interaction = await self.wait_for_click(player, step)
+        if interaction is None:
+            return None
+        await self.api(interaction.response.defer(), None)
+        return engine.PLAYS[play_id]
 
     async def collect_move_choices(self, player, is_first_response):
+        if player.ai is not None:
+            await self.collect_ai_move_choices(player)
+            return
         root_interaction = player.initial_challenge
+        if root_interaction is None:
+            root_interaction = await self.reconnect(player)
         if not player.special_used:
             special_info = f"Special available: {player.special.name}\n"
         else:
             special_info = f"Special already used ({player.special.name})\n"
+        if self.prompt_mode == COMBINED_PROMPTS:
+            await self.collect_combined_choices(player, root_interaction, special_info)
+            return
         first_header = f"{special_info}Choose first move:"
-        first_view = self.make_play_selection_view(player, False)
+        first_view = self.make_play_selection_view(player, prompts.FIRST)
 
         first_message = None
         if is_first_response:
-            first_message = await root_interaction.response.send_message(
-                first_header, view=first_view, ephemeral=True
+            first_message = await self.api(
+                root_interaction.response.send_message(
+                    first_header, view=first_view, ephemeral=True
+                ),
+                None,
             )
         else:
-            first_message = await root_interaction.followup.send(
-                first_header, view=first_view, ephemeral=True
+            first_message = await self.api(
+                root_interaction.followup.send(
+                    first_header, view=first_view, ephemeral=True
+                )
             )
-        first_play = await first_view.wait_for_value()
+        first_play = await self.wait_for_play(player, prompts.FIRST)
         player.add_queued_play(first_play)
 
         if first_play == None:
-            await first_message.delete()
+            await self.api(first_message.delete())
             raise TimeoutError
-        will_change_stance = first_play.changes_stance
-        if first_play in special_attack_cards:
+        if first_play.category & SPECIAL:
             player.special_used = True
 
         second_header = (
             f"{special_info}First Move: {first_play.name}\nChoose second move:"
         )
 
-        second_view = self.make_play_selection_view(player, will_change_stance)
-        await first_message.edit(content=second_header, view=second_view)
-        second_play = await second_view.wait_for_value()
+        second_view = self.make_play_selection_view(player, prompts.SECOND)
+        await self.api(first_message.edit(content=second_header, view=second_view))
+        second_play = await self.wait_for_play(player, prompts.SECOND)
         if second_play == None:
-            await first_message.delete()
+            await self.api(first_message.delete())
             raise TimeoutError
-        if second_play in special_attack_cards:
+        if second_play.category & SPECIAL:
             player.special_used = True
-        await first_message.delete()
+        await self.api(first_message.delete())
         player.add_queued_play(second_play)
+
+    async def collect_combined_choices(self, player, root_interaction, special_info):
+        # One message per player, edited for each turn rather than sent and
+        # deleted, and each pick is answered by editing it in place. That's
+        # three calls per player per turn, against five with buttons.
+        header = f"{special_info}Choose your moves for turn {len(self.play_log) + 1}:"
+        view = self.make_combined_view(player)
+        message = self.prompt_messages.get(player.user_id)
+        if message is not None:
+            try:
+                await self.api(message.edit(content=header, view=view))
+            except discord.HTTPException:
+                # dismissed by the player or past the followup's lifetime
+                message = None
+        if message is None:
+            message = await self.api(
+                root_interaction.followup.send(header, view=view, ephemeral=True)
+            )
+            self.prompt_messages[player.user_id] = message
+
+        # one clock for the whole turn, so re-picking doesn't restart it
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.turn_timeout
+        first = None
+        while True:
+            menu, interaction = await self.wait_for_click(
+                player, prompts.COMBINED, deadline - loop.time()
+            )
+            if interaction is None:
+                del self.prompt_messages[player.user_id]
+                await self.api(message.delete())
+                raise TimeoutError
+            play = int(interaction.data["values"][0])
+            if menu == prompts.FIRST and any(
+                play == p for _, p in self.legal_specs(player)
+            ):
+                first = play
+                await self.api(
+                    interaction.response.edit_message(
+                        view=self.make_combined_view(player, first)
+                    ),
+                    None,
+                )
+            elif (
+                menu == prompts.SECOND
+                and first is not None
+                and any(play == p for _, p in self.legal_specs(player, first))
+            ):
+                await self.api(
+                    interaction.response.edit_message(
+                        content=f"{special_info}Locked in: {engine.PLAYS[first].name}, "
+                        f"then {engine.PLAYS[play].name}. Waiting for the next turn...",
+                        view=None,
+                    ),
+                    None,
+                )
+                break
+            else:
+                await self.api(interaction.response.defer(), None)
+
+        for play_id in (first, play):
+            chosen = engine.PLAYS[play_id]
+            if chosen.category & SPECIAL:
+                player.special_used = True
+            player.add_queued_play(chosen)
+
+    async def reconnect(self, player):
+        # a restored duel has no interaction to send a player's prompts
+        # through until they press a button
+        button = discord.ui.Button(style=discord.ButtonStyle.primary, label="Continue")
+        view = prompts.make_view(
+            self.match_id, len(self.play_log), prompts.CONTINUE, [(button, 0)]
+        )
+        message = await self.post(
+            f"{player.mention}, your duel was restored after a restart. "
+            "Press Continue to choose your moves.",
+            view,
+        )
+        _, interaction = await self.wait_for_click(player, prompts.CONTINUE)
+        await self.api(message.delete())
+        if interaction is None:
+            raise TimeoutError
+        await self.api(interaction.response.defer(), None)
+        player.initial_challenge = interaction
+        return interaction
+
+    async def collect_ai_move_choices(self, player):
+        side = 0 if player is self.p1 else 1
+        plays = await player.ai.choose(self.engine_state(True), side)
+        for play_id in plays:
+            play = engine.PLAYS[play_id]
+            if play.category & SPECIAL:
+                player.special_used = True
+            player.add_queued_play(play)
@@ -0,0 +1,96 @@
+# Write-ahead journal for duels in progress.
+#
+# A duel is saved when it starts and gets one small append per resolved
+# turn-half: the turn's four plays and the packed engine state after it. The
+# writes go through the database's group commits, and the rows are dropped
+# when the duel ends. On startup every journalled duel is rebuilt from its
+# last state and picks up where it left off.
+
+from ai import MonteCarloAI
+from game import GameState, SavedMember
+import engine
+
+
+class MatchJournal:
+    def __init__(self, db_handler, guild_id):
+        self.db_handler = db_handler
+        self.guild_id = guild_id
+
+    def started(self, game):
+        p1 = game.p1
+        p2 = game.p2
+        self.db_handler.save_live_match(
+            game.match_id,
+            self.guild_id,
+            game.channel.id,
+            p1.user_id,
+            p2.user_id,
+            p1.name,
+            p2.name,
+            p1.emoji,
+            p2.emoji,
+            p1.special.id,
+            p2.special.id,
+            p2.ai is not None,
+            game.seed,
+            game.started_at,
+        )
+
+    def half_resolved(self, game, state):
+        # even seq for the first half of a turn, odd for the second
+        seq = (len(game.play_log) - 1) * 2 + (0 if state[engine.HALF] else 1)
+        self.db_handler.append_match_event(
+            game.match_id, seq, game.play_log[-1], engine.pack(state)
+        )
+
+    def finished(self, game):
+        self.db_handler.delete_live_match(game.match_id)
+
+
+def restore(row, events, channel, journal):
+    # rebuilds a GameState from a live_matches row and its events
+    (
+        match_id,
+        _,
+        _,
+        p1_id,
+        p2_id,
+        p1_name,
+        p2_name,
+        p1_emoji,
+        p2_emoji,
+        p1_special,
+        p2_special,
+        p2_ai,
+        seed,
+        started_at,
+    ) = row
+    game = GameState(
+        SavedMember(p1_id, p1_name),
+        SavedMember(p2_id, p2_name),
+        channel,
+        None,
+        None,
+        p1_emoji,
+        p2_emoji,
+        p2_ai=MonteCarloAI() if p2_ai else None,
+        seed=seed,
+        journal=journal,
+    )
+    game.match_id = match_id
+    game.started_at = started_at
+    game.p1.special = engine.PLAYS[p1_special]
+    game.p2.special = engine.PLAYS[p2_special]
+    for seq, *plays, _ in events:
+        if seq % 2 == 0:
+            game.play_log.append(tuple(plays))
+    if events:
+        state = engine.unpack(events[-1][-1])
+        game.apply_engine_state(state)
+        if state[engine.HALF]:
+            # stopped between the two halves of a turn, finish it first
+            plays = game.play_log[-1]
+            game.p1.chosen_plays = [engine.PLAYS[p] for p in plays[:2]]
+            game.p2.chosen_plays = [engine.PLAYS[p] for p in plays[2:]]
+            game.interrupted = True
+    return game
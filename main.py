@@ -4,25 +4,52 @@ from discord import app_commands, Interaction
 from discord.ext import commands, tasks
 import asyncio
 from game import GameState
+from ai import MonteCarloAI, shutdown_executor
 from database_handler import DatabaseHandler
+from ratings import Leaderboard, GLOBAL
+from replay import ReplayLog
+from journal import MatchJournal, restore
+import prompts
+from game import PROMPT_TIMEOUT
+from challenges import ChallengeRegistry
+from matches import MatchRegistry
+from supervisor import MatchSupervisor, QUEUED, REJECTED
+from outbound import outbox
+import metrics
+import profiler
+from timers import wheel
 import logging
 import sys
 import os
+import signal
+import time
+from typing import Literal
 
 intents = discord.Intents.default()
 intents.message_content = True
 bot = commands.Bot(command_prefix="!", intents=intents)
 
 # In-memory stores
-challenges = {}  # {channel_id: {challenger_id: opponent_id}}
-ongoing_matches = {}  # {channel_id: GameState}
-player_timeouts = {}  # {channel_id: {player_id: asyncio.Task}}
+challenges = ChallengeRegistry()
+ongoing_matches = MatchRegistry()
 
-# Database handler
-db_handler = DatabaseHandler("state.db")
+# Database handler and replay log, opened under the __main__ guard at the
+# bottom so ai's worker processes, which re-import this module, don't open
+# the database or start a second writer thread
+db_handler = None
+replay_log = None
+
+# Finished matches older than this get rolled up into aggregate records
+HISTORY_RETENTION = 90 * 24 * 60 * 60
 
 # Store configured channels
 configured_channels = {}  # {guild_id: channel_id}
+turn_timers = {}  # {guild_id: (turn_timeout, warn_before)}
+
+# Ratings and rankings, rebuilt from the database on startup
+leaderboard = Leaderboard()
+ratings_loaded = False
+matches_resumed = False
 
 for handler in logging.root.handlers[:]:
     logging.root.removeHandler(handler)
@@ -41,7 +68,14 @@ logger = logging.getLogger("main")
 @bot.event
 async def on_ready():
     logger.info(f"Logged in as {bot.user.name}")
-    load_configured_channels()
+    await load_configured_channels()
+    await load_turn_timers()
+    await load_ratings()
+    await resume_matches()
+    install_signal_handlers()
+    await metrics.serve()
+    if not roll_up_history.is_running():
+        roll_up_history.start()
     try:
         synced = await bot.tree.sync()
         logger.info(f"Synced {len(synced)} command(s)")
@@ -49,9 +83,9 @@ async def on_ready():
         logger.error(f"Error syncing commands: {e}")
 
 
-def load_configured_channels():
+async def load_configured_channels():
     global configured_channels
-    configured_channels = db_handler.get_configured_channels()
+    configured_channels = await db_handler.get_configured_channels()
     logger.info(f"Loaded configured channels from database: {configured_channels}")
 
 
@@ -61,7 +95,7 @@ def load_configured_channels():
 async def use_channel(interaction: discord.Interaction):
     channel_id = interaction.channel_id
     guild_id = interaction.guild_id
-    db_handler.set_configured_channel(guild_id, channel_id)
+    await db_handler.set_configured_channel(guild_id, channel_id)
     configured_channels[guild_id] = channel_id
     logger.info(f"Updated configured channel for guild {guild_id}: {channel_id}")
     logger.info(f"Current configured channels: {configured_channels}")
@@ -70,6 +104,286 @@ async def use_channel(interaction: discord.Interaction):
     )
 
 
+async def load_turn_timers():
+    global turn_timers
+    turn_timers = await db_handler.get_turn_timers()
+    logger.info(f"Loaded turn timers from database: {turn_timers}")
+
+
+def turn_settings(guild_id):
+    turn_timeout, warn_before = turn_timers.get(guild_id, (PROMPT_TIMEOUT, None))
+    return {"turn_timeout": turn_timeout, "warn_before": warn_before}
+
+
+@bot.tree.command(
+    name="turntimer", description="Set how long players get to choose their moves"
+)
+@app_commands.default_permissions(manage_guild=True)
+async def turn_timer(
+    interaction: discord.Interaction,
+    seconds: app_commands.Range[int, 30, 840],
+    warn_before: app_commands.Range[int, 5, 60] = None,
+):
+    guild_id = interaction.guild_id
+    await db_handler.set_turn_timer(guild_id, seconds, warn_before)
+    turn_timers[guild_id] = (seconds, warn_before)
+    logger.info(f"Updated turn timer for guild {guild_id}: {turn_timers[guild_id]}")
+    warning = f", with a warning {warn_before}s before" if warn_before else ""
+    await interaction.response.send_message(
+        f"New duels will give players {seconds}s to choose{warning}.",
+        ephemeral=True,
+    )
+
+
+@bot.tree.command(name="profile", description="Profile the bot for a while")
+@app_commands.default_permissions(administrator=True)
+async def profile(
+    interaction: discord.Interaction,
+    seconds: app_commands.Range[int, 1, 120] = 30,
+    mode: Literal["cprofile", "sampling"] = "cprofile",
+    memory: bool = False,
+):
+    if not await bot.is_owner(interaction.user):
+        await interaction.response.send_message(
+            "Only the bot's owner can do that.", ephemeral=True
+        )
+        return
+    if profiler.running:
+        await interaction.response.send_message(
+            "A profile is already running.", ephemeral=True
+        )
+        return
+    await interaction.response.send_message(
+        f"Profiling for {seconds}s...", ephemeral=True
+    )
+    logger.info(f"Profiling for {seconds}s ({mode}, memory {memory})")
+    try:
+        paths = await profiler.profile(seconds, mode, memory, len(ongoing_matches))
+    except Exception as e:
+        logger.exception("Profiling failed")
+        await interaction.followup.send(f"Profiling failed: {e}", ephemeral=True)
+        return
+    logger.info(f"Wrote {paths}")
+    await interaction.followup.send(
+        "Wrote " + ", ".join(f"`{path}`" for path in paths), ephemeral=True
+    )
+
+
+async def load_ratings():
+    # on_ready fires again after reconnects, the index is only built once
+    global ratings_loaded
+    if ratings_loaded:
+        return
+    ratings_loaded = True
+    leaderboard.load(await db_handler.get_ratings())
+    logger.info(f"Loaded {len(leaderboard.ratings)} ratings from database")
+
+
+async def resume_matches():
+    # picks up the duels that were running when the bot last stopped
+    global matches_resumed
+    if matches_resumed:
+        return
+    matches_resumed = True
+    resumed = 0
+    for row, events in await db_handler.get_live_matches():
+        match_id, guild_id, channel_id, p1_id, p2_id = row[:5]
+        try:
+            channel = bot.get_channel(channel_id) or await bot.fetch_channel(channel_id)
+        except discord.HTTPException:
+            channel = None
+        game_state = restore(row, events, channel, MatchJournal(db_handler, guild_id))
+        for name, value in turn_settings(guild_id).items():
+            setattr(game_state, name, value)
+        winner, _ = game_state.check_for_game_end()
+        if channel is None or winner:
+            db_handler.delete_live_match(match_id)
+            continue
+        if submit_match(game_state, guild_id) in (None, REJECTED):
+            db_handler.delete_live_match(match_id)
+            continue
+        resumed += 1
+    logger.info(f"Resumed {resumed} duel(s)")
+
+
+def submit_match(game_state, guild_id):
+    # The players are registered from here on, queued or not, so they can't
+    # be put in a second duel while this one waits for a slot. None if one
+    # of them already is in one, otherwise the supervisor's status.
+    if not ongoing_matches.add(game_state):
+        return None
+    status = supervisor.submit(game_state, guild_id)
+    if status == REJECTED:
+        ongoing_matches.remove(game_state)
+    return status
+
+
+def expire_match(game_state, guild_id):
+    # waited in the supervisor's queue for too long to start
+    ongoing_matches.remove(game_state)
+    db_handler.delete_live_match(game_state.match_id)
+    outbox.post(
+        game_state.channel,
+        f"{game_state.p1.mention} and {game_state.p2.mention}, no duel slot "
+        "freed up in time, so your duel has been called off. Please try again.",
+    )
+
+
+async def run_match(game_state, guild_id):
+    logger.info(
+        f"Starting duel {game_state.match_id} between {game_state.p1.name} and "
+        f"{game_state.p2.name} (seed {game_state.seed})"
+    )
+    try:
+        await game_state.run_until_end()
+    except asyncio.CancelledError:
+        # the duel's idle timer cancels it if it gets stuck; otherwise the bot
+        # is shutting down and the journal is kept to resume from
+        if not game_state.reaped:
+            raise
+    except Exception:
+        logger.exception(f"Duel {game_state.match_id} failed")
+        log_trace(game_state)
+        db_handler.delete_live_match(game_state.match_id)
+        try:
+            await outbox.post(
+                game_state.channel,
+                "Something went wrong and this duel has been called off.",
+            )
+        except discord.HTTPException:
+            pass
+        return
+    finally:
+        ongoing_matches.remove(game_state)
+    if game_state.reaped:
+        logger.warning(f"Duel {game_state.match_id} got stuck and was called off")
+        log_trace(game_state)
+        db_handler.delete_live_match(game_state.match_id)
+        outbox.post(game_state.channel, "This duel got stuck and has been called off.")
+        return
+    # practice duels against the bot aren't rated or kept in match history
+    if game_state.p2.ai is None:
+        record_finished_match(game_state, guild_id)
+    else:
+        append_replay(game_state, guild_id)
+
+
+supervisor = MatchSupervisor(run_match, expire_match)
+
+metrics.StatsGauges("duelbot_matches", ongoing_matches.stats)
+metrics.StatsGauges("duelbot_challenges", challenges.stats)
+metrics.StatsGauges("duelbot_supervisor", supervisor.stats)
+metrics.StatsGauges("duelbot_outbox", outbox.stats)
+metrics.StatsGauges("duelbot_stats_cache", lambda: db_handler.stats_cache.stats())
+metrics.StatsGauges("duelbot_timers", lambda: {"scheduled": wheel.count})
+
+
+def log_trace(game_state):
+    # empty unless tracing is on, see tracing.py
+    lines = game_state.trace.dump()
+    if lines:
+        logger.info(f"Trace of duel {game_state.match_id}:\n" + "\n".join(lines))
+
+
+def log_running_traces():
+    for _, game_state in supervisor.running.values():
+        log_trace(game_state)
+
+
+async def start_match(interaction, game_state):
+    # the interaction has already been responded to
+    status = submit_match(game_state, interaction.guild_id)
+    if status is None:
+        # someone joined another duel between being checked and getting here
+        await interaction.followup.send(
+            "The duel couldn't start, one of the players is already dueling.",
+            ephemeral=True,
+        )
+    elif status == QUEUED:
+        await interaction.followup.send(
+            "All duel slots are busy, your duel will start as soon as one frees up.",
+            ephemeral=True,
+        )
+    elif status == REJECTED:
+        await interaction.followup.send(
+            "The bot is too busy to start a duel right now, please try again later.",
+            ephemeral=True,
+        )
+
+
+def install_signal_handlers():
+    try:
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(
+            signal.SIGTERM, lambda: asyncio.ensure_future(shutdown())
+        )
+        # kill -USR1 to see what every running duel has been doing
+        loop.add_signal_handler(signal.SIGUSR1, log_running_traces)
+    except NotImplementedError:
+        # no signal handlers on Windows event loops
+        pass
+
+
+async def shutdown():
+    logger.info(f"Shutting down with {supervisor.stats()}, outbox {outbox.stats()}")
+    channels = {game.channel for _, game in supervisor.running.values()}
+    await asyncio.gather(
+        *(
+            outbox.post(
+                channel,
+                "The bot is restarting, duels here will pick up where they left off.",
+            )
+            for channel in channels
+        ),
+        return_exceptions=True,
+    )
+    await supervisor.drain()
+    await bot.close()
+
+
+@tasks.loop(hours=24)
+async def roll_up_history():
+    await db_handler.roll_up_history(time.time() - HISTORY_RETENTION)
+    logger.info("Rolled up old match history")
+
+
+def append_replay(game_state, guild_id):
+    # the replay is a nice-to-have, losing it mustn't lose the result
+    try:
+        replay_log.append(game_state, guild_id)
+    except Exception:
+        logger.exception(f"Couldn't append a replay of duel {game_state.match_id}")
+
+
+def record_finished_match(game_state, guild_id):
+    p1 = game_state.p1
+    p2 = game_state.p2
+    winner = game_state.winner
+    db_handler.record_match(
+        game_state.match_id,
+        guild_id,
+        p1.user_id,
+        p2.user_id,
+        p1.special.id,
+        p2.special.id,
+        winner.user_id if winner else None,
+        game_state.forfeit,
+        game_state.started_at,
+        game_state.ended_at,
+        game_state.play_log,
+        game_state.seed,
+    )
+    if winner:
+        db_handler.update_stats(winner.user_id, guild_id, True)
+        db_handler.update_stats(game_state.loser.user_id, guild_id, False)
+        db_handler.set_ratings(
+            leaderboard.record_result(
+                guild_id, winner.user_id, game_state.loser.user_id
+            )
+        )
+    append_replay(game_state, guild_id)
+
+
 def is_configured_channel():
 
     async def predicate(interaction: discord.Interaction) -> bool:
@@ -142,21 +456,17 @@ async def challenge(
 ):
 
     channel_id = interaction.channel_id
-    if channel_id in ongoing_matches:
-        await interaction.followup.send(
-            "A game is already in progress in this channel.", ephemeral=True
-        )
-        return
-
     if interaction.user == opponent:
         await interaction.followup.send("You can't challenge yourself!", ephemeral=True)
         return
 
-    if channel_id not in challenges:
-        challenges[channel_id] = {}
-
     challenger_id = interaction.user.id
     opponent_id = opponent.id
+    if ongoing_matches.busy(challenger_id, opponent_id):
+        await interaction.response.send_message(
+            "One of you is already in a duel.", ephemeral=True
+        )
+        return
 
     # Check if this is an acceptance of an existing challenge
     # if (
@@ -190,44 +500,71 @@ async def challenge(
     #     await game_state.run_until_end()
     #     del ongoing_matches[channel_id]
     # elif (
-    if (
-        opponent_id in challenges[channel_id]
-        and challenger_id in challenges[channel_id][opponent_id]
-    ):
+    accepted = challenges.take(channel_id, opponent_id, challenger_id)
+    if accepted is not None:
         await interaction.response.send_message(
             "Duel confirmed! This msg is logistically required :)", ephemeral=True
         )
         # await interaction.response.defer(ephemeral=True)
         print("This is reverse invocation")
         # Start the game (reverse order because the original challenger is now the opponent)
-        challenger_interaction = challenges[channel_id][opponent_id][
-            1
-        ]  # Get the stored interaction
         game_state = GameState(
             opponent,
             interaction.user,
             interaction.channel,
-            challenger_interaction,
+            accepted.interaction,
             interaction,
-            challenges[channel_id][opponent_id][2],
+            accepted.emoji,
             emoji,
+            journal=MatchJournal(db_handler, interaction.guild_id),
+            **turn_settings(interaction.guild_id),
         )
-        ongoing_matches[channel_id] = game_state
-        del challenges[channel_id][opponent_id]
-        await game_state.run_until_end()
-        del ongoing_matches[channel_id]
+        await start_match(interaction, game_state)
     else:
         # This is a new challenge
-        challenges[channel_id][challenger_id] = (
-            opponent_id,
-            interaction,
-            emoji,
-        )  # Store the challenger's interaction and emoji
+        if (
+            challenges.add(channel_id, challenger_id, opponent_id, interaction, emoji)
+            is None
+        ):
+            await interaction.response.send_message(
+                f"You already have {challenges.per_user} open challenges. "
+                "Wait for one to be answered or expire.",
+                ephemeral=True,
+            )
+            return
         await interaction.response.send_message(
             f"{interaction.user.mention} has challenged {opponent.mention} to a samurai duel! {opponent.mention}, use /challenge to accept.",
             ephemeral=False,
         )
-    logger.debug(f"Challenge command completed. Current challenges: {challenges}")
+    logger.debug(f"Challenge command completed. Challenges: {challenges.stats()}")
+
+
+@bot.tree.command(
+    name="practice", description="Practice a samurai duel against the bot"
+)
+async def practice(interaction: discord.Interaction, emoji: str = None):
+    if ongoing_matches.busy(interaction.user.id):
+        await interaction.response.send_message(
+            "You're already in a duel.", ephemeral=True
+        )
+        return
+
+    await interaction.response.send_message(
+        "Practice duel confirmed! This msg is logistically required :)",
+        ephemeral=True,
+    )
+    game_state = GameState(
+        interaction.user,
+        bot.user,
+        interaction.channel,
+        interaction,
+        None,
+        emoji,
+        p2_ai=MonteCarloAI(),
+        journal=MatchJournal(db_handler, interaction.guild_id),
+        **turn_settings(interaction.guild_id),
+    )
+    await start_match(interaction, game_state)
 
 
 # @bot.tree.command(name="forfeit", description="Forfeit the current game")
@@ -272,7 +609,7 @@ async def challenge(
 @bot.tree.command(name="stats", description="Check your duel statistics")
 async def stats(interaction: discord.Interaction):
     await check_configured_channel(interaction)
-    user_stats = db_handler.get_stats(interaction.user.id, interaction.guild.id)
+    user_stats = await db_handler.get_stats(interaction.user.id, interaction.guild.id)
     total_games = user_stats["wins"] + user_stats["losses"]
     win_rate = (user_stats["wins"] / total_games * 100) if total_games > 0 else 0
 
@@ -285,35 +622,54 @@ async def stats(interaction: discord.Interaction):
     )
 
 
-# @bot.event
-# async def on_interaction(interaction: discord.Interaction):
-#     if interaction.type == discord.InteractionType.component:
-#         custom_id = interaction.data["custom_id"]
-#         if custom_id.startswith("move_"):
-#             await interaction.response.defer(ephemeral=True)
-
-#             if interaction.channel_id == configured_channels.get(interaction.guild_id):
-#                 try:
-#                     move = custom_id.split("_", 1)[1]
-#                     channel_id = interaction.channel_id
-#                     if channel_id in ongoing_matches:
-#                         game = ongoing_matches[channel_id]
-#                         await game.make_move(interaction.user, move)
-#                     else:
-#                         await interaction.followup.send(
-#                             "There is no ongoing game in this channel.", ephemeral=True
-#                         )
-#                 except Exception as e:
-#                     logging.exception("Error handling move")
-#                     await interaction.followup.send(
-#                         f"An error occurred: {str(e)}", ephemeral=True
-#                     )
-#             else:
-#                 await interaction.followup.send(
-#                     "This command can only be used in the configured channel.",
-#                     ephemeral=True,
-#                 )
-
-
-# Run the bot
-bot.run(os.environ.get("DUELBOT_TOKEN"))
+@bot.tree.command(name="record", description="Check your record against another player")
+async def record(interaction: discord.Interaction, opponent: discord.Member):
+    if not await check_configured_channel(interaction):
+        return
+    result = await db_handler.get_head_to_head(
+        interaction.user.id, opponent.id, interaction.guild.id
+    )
+    await interaction.response.send_message(
+        f"Duel record for {interaction.user.mention} against {opponent.mention}:\n"
+        f"Wins: {result['wins']}\n"
+        f"Losses: {result['losses']}"
+    )
+
+
+@bot.tree.command(name="leaderboard", description="Show the top rated duelists")
+async def leaderboard_command(
+    interaction: discord.Interaction, all_servers: bool = False
+):
+    if not await check_configured_channel(interaction):
+        return
+    scope = GLOBAL if all_servers else interaction.guild.id
+    lines = [
+        f"{i}. <@{user_id}> - {rating:.0f}"
+        for i, (user_id, rating) in enumerate(leaderboard.top(scope, 10), 1)
+    ]
+    if not lines:
+        lines.append("No rated duels yet!")
+    own = leaderboard.rank(interaction.user.id, scope)
+    if own:
+        lines.append(f"\nYou are #{own[0]} with a rating of {own[1]:.0f}")
+    await interaction.response.send_message(
+        "Leaderboard:\n" + "\n".join(lines),
+        allowed_mentions=discord.AllowedMentions.none(),
+    )
+
+
+@bot.event
+async def on_interaction(interaction: discord.Interaction):
+    # every duel button is routed from here by its custom_id, see prompts.py
+    if interaction.type == discord.InteractionType.component:
+        await prompts.router.dispatch(interaction)
+
+
+# Run the bot, guarded so ai's worker processes can import this module safely
+if __name__ == "__main__":
+    db_handler = DatabaseHandler("state.db")
+    replay_log = ReplayLog("replays")
+    bot.run(os.environ.get("DUELBOT_TOKEN"))
+    shutdown_executor()
+    db_handler.close()
+    replay_log.close()
@@ -0,0 +1,66 @@
+# Duels in progress.
+#
+# Matches are keyed by match id and indexed by channel and by player, so a
+# channel can host any number of duels and every lookup is O(1). A player is
+# in at most one duel at a time; the bot's practice opponent isn't indexed.
+# Each GameState carries its own lock for changes to its state.
+
+
+class MatchRegistry:
+    def __init__(self):
+        # match_id -> GameState
+        self.matches = {}
+        # channel_id -> {match_id: GameState}
+        self.by_channel = {}
+        # user_id -> GameState
+        self.by_player = {}
+
+    def __len__(self):
+        return len(self.matches)
+
+    def __contains__(self, match_id):
+        return match_id in self.matches
+
+    def get(self, match_id):
+        return self.matches.get(match_id)
+
+    def in_channel(self, channel_id):
+        return list(self.by_channel.get(channel_id, {}).values())
+
+    def for_player(self, user_id):
+        return self.by_player.get(user_id)
+
+    def busy(self, *user_ids):
+        return any(user_id in self.by_player for user_id in user_ids)
+
+    def _players(self, game):
+        return [p.user_id for p in (game.p1, game.p2) if p.ai is None]
+
+    def add(self, game):
+        # False if one of the players is already dueling
+        players = self._players(game)
+        if game.match_id in self.matches or self.busy(*players):
+            return False
+        self.matches[game.match_id] = game
+        self.by_channel.setdefault(game.channel.id, {})[game.match_id] = game
+        for user_id in players:
+            self.by_player[user_id] = game
+        return True
+
+    def remove(self, game):
+        if self.matches.pop(game.match_id, None) is None:
+            return
+        channel = self.by_channel[game.channel.id]
+        del channel[game.match_id]
+        if not channel:
+            del self.by_channel[game.channel.id]
+        for user_id in self._players(game):
+            if self.by_player.get(user_id) is game:
+                del self.by_player[user_id]
+
+    def stats(self):
+        return {
+            "matches": len(self.matches),
+            "channels": len(self.by_channel),
+            "players": len(self.by_player),
+        }
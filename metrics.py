@@ -0,0 +1,173 @@
+# Latency histograms and counters for the hot paths, served in Prometheus'
+# text format on 127.0.0.1:DUELBOT_METRICS_PORT.
+#
+# Nothing is collected unless the port is set; observe() returns straight
+# away, so timed code only pays for a clock() call. Gauges are read from the
+# registries' stats() when scraped, so they cost nothing in between.
+
+import asyncio
+import bisect
+import logging
+import os
+import time
+
+logger = logging.getLogger(__name__)
+
+PORT = int(os.environ.get("DUELBOT_METRICS_PORT", "0"))
+ENABLED = PORT > 0
+LOOP_LAG_INTERVAL = 0.5
+
+# seconds
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+WAIT_BUCKETS = (1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 900)
+SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256)
+
+clock = time.perf_counter
+# everything render() writes out
+collectors = []
+
+
+def _labels(*pairs):
+    labels = ",".join(f'{name}="{value}"' for name, value in pairs if name)
+    return f"{{{labels}}}" if labels else ""
+
+
+class Counter:
+    def __init__(self, name, help, label=None):
+        self.name = name
+        self.help = help
+        self.label = label
+        # label value -> count
+        self.series = {}
+        collectors.append(self)
+
+    def inc(self, label=None, amount=1):
+        if ENABLED:
+            self.series[label] = self.series.get(label, 0) + amount
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for label, count in self.series.items():
+            yield f"{self.name}{_labels((self.label, label))} {count}"
+
+
+class Histogram:
+    def __init__(self, name, help, buckets=LATENCY_BUCKETS, label=None):
+        self.name = name
+        self.help = help
+        self.buckets = buckets
+        self.label = label
+        # label value -> [count per bucket..., count above them, sum]
+        self.series = {}
+        collectors.append(self)
+
+    def observe(self, value, label=None):
+        if not ENABLED:
+            return
+        series = self.series.get(label)
+        if series is None:
+            series = self.series[label] = [0] * (len(self.buckets) + 2)
+        series[bisect.bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def since(self, start, label=None):
+        # start is a clock() reading
+        self.observe(clock() - start, label)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for label, series in self.series.items():
+            label_pair = (self.label, label)
+            total = 0
+            for bound, count in zip(self.buckets + ("+Inf",), series):
+                total += count
+                yield f"{self.name}_bucket{_labels(label_pair, ('le', bound))} {total}"
+            yield f"{self.name}_sum{_labels(label_pair)} {series[-1]}"
+            yield f"{self.name}_count{_labels(label_pair)} {total}"
+
+
+class StatsGauges:
+    # every number in stats() as a gauge named {prefix}_{key}
+    def __init__(self, prefix, stats):
+        self.prefix = prefix
+        self.stats = stats
+        collectors.append(self)
+
+    def render(self):
+        for key, value in self.stats().items():
+            if isinstance(value, (int, float)):
+                yield f"# TYPE {self.prefix}_{key} gauge"
+                yield f"{self.prefix}_{key} {value}"
+
+
+PROMPT_WAIT = Histogram(
+    "duelbot_prompt_wait_seconds",
+    "Time from a prompt being shown to the player clicking it",
+    WAIT_BUCKETS,
+    label="step",
+)
+PROMPT_TIMEOUTS = Counter(
+    "duelbot_prompt_timeouts_total", "Prompts that ran out of time", label="step"
+)
+TURN_RESOLUTION = Histogram(
+    "duelbot_turn_resolution_seconds", "Time to resolve a turn-half"
+)
+DISCORD_LATENCY = Histogram(
+    "duelbot_discord_call_seconds",
+    "Duration of Discord API calls, not counting time spent paced in outbound",
+    label="call",
+)
+DB_READ = Histogram(
+    "duelbot_db_read_seconds", "Duration of database reads", label="query"
+)
+DB_COMMIT = Histogram(
+    "duelbot_db_commit_seconds", "Duration of the writer thread's group commits"
+)
+DB_BATCH = Histogram("duelbot_db_batch_writes", "Writes per group commit", SIZE_BUCKETS)
+LOOP_LAG = Histogram(
+    "duelbot_event_loop_lag_seconds", "How late the event loop wakes a sleeper"
+)
+
+
+def render():
+    return "\n".join(line for c in collectors for line in c.render()) + "\n"
+
+
+_server = None
+
+
+async def serve():
+    # starts the exporter once, if DUELBOT_METRICS_PORT is set
+    global _server
+    if not ENABLED or _server is not None:
+        return
+    _server = await asyncio.start_server(_handle, "127.0.0.1", PORT)
+    asyncio.create_task(_watch_loop_lag())
+    logger.info(f"Serving metrics on 127.0.0.1:{PORT}")
+
+
+async def _handle(reader, writer):
+    # answers any request with the metrics, that's all Prometheus needs
+    try:
+        await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), 5)
+        body = render().encode()
+        writer.write(
+            b"HTTP/1.1 200 OK\r\n"
+            b"Content-Type: text/plain; version=0.0.4\r\n"
+            b"Content-Length: %d\r\n"
+            b"Connection: close\r\n\r\n" % len(body) + body
+        )
+        await writer.drain()
+    except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _watch_loop_lag():
+    while True:
+        start = clock()
+        await asyncio.sleep(LOOP_LAG_INTERVAL)
+        LOOP_LAG.observe(max(clock() - start - LOOP_LAG_INTERVAL, 0))
@@ -0,0 +1,188 @@
+# Outbound Discord calls, paced to stay inside the rate limits.
+#
+# Every call takes a token from a global bucket, and prompts are served
+# before narration when tokens run short. Channel posts also go through a
+# FIFO queue per channel paced by that channel's bucket, and posts that pile
+# up behind the limit are merged into one message when they fit, so many
+# duels sharing a channel cost fewer sends. Interaction responses aren't
+# bound by the global limit and skip the bucket (priority=None). discord.py
+# still handles any 429 that gets through; this keeps us from hitting them.
+
+import asyncio
+import logging
+import time
+from collections import deque
+import metrics
+from timers import wheel
+
+logger = logging.getLogger(__name__)
+
+PROMPT = 0
+NARRATION = 1
+MAX_MESSAGE_LENGTH = 2000
+# (requests, seconds)
+CHANNEL_RATE = (5, 5.0)
+GLOBAL_RATE = (50, 1.0)
+
+
+class TokenBucket:
+    def __init__(self, capacity, per):
+        self.capacity = capacity
+        self.rate = capacity / per
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self):
+        # seconds until a token is free
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class _ChannelQueue:
+    __slots__ = ("bucket", "pending", "task")
+
+    def __init__(self):
+        self.bucket = TokenBucket(*CHANNEL_RATE)
+        # (content, view, future, queued at)
+        self.pending = deque()
+        self.task = None
+
+
+class Outbox:
+    def __init__(self):
+        self.bucket = TokenBucket(*GLOBAL_RATE)
+        # waiting for a global token, by priority
+        self.waiters = (deque(), deque())
+        self._wakeup = None
+        # channel_id -> _ChannelQueue
+        self.channels = {}
+        self.queued = 0
+        self.sent = 0
+        self.merged = 0
+        self.latency_total = 0.0
+        self.latency_max = 0.0
+
+    async def _acquire(self, priority):
+        if not any(self.waiters[: priority + 1]) and not self.bucket.delay():
+            self.bucket.take()
+            return
+        future = asyncio.get_running_loop().create_future()
+        self.waiters[priority].append(future)
+        self._wake()
+        await future
+
+    def _wake(self):
+        self._wakeup = None
+        while any(self.waiters):
+            delay = self.bucket.delay()
+            if delay:
+                if self._wakeup is None:
+                    self._wakeup = asyncio.get_running_loop().call_later(
+                        delay, self._wake
+                    )
+                return
+            waiters = self.waiters[0] or self.waiters[1]
+            future = waiters.popleft()
+            if not future.done():
+                self.bucket.take()
+                future.set_result(None)
+
+    def _record(self, queued_at):
+        latency = time.monotonic() - queued_at
+        self.sent += 1
+        self.latency_total += latency
+        self.latency_max = max(self.latency_max, latency)
+
+    async def run(self, call, priority=PROMPT):
+        # awaits the call once the global budget allows it
+        queued_at = time.monotonic()
+        if priority is not None:
+            try:
+                await self._acquire(priority)
+            except asyncio.CancelledError:
+                call.close()
+                raise
+        name = getattr(call, "__qualname__", type(call).__name__)
+        start = metrics.clock()
+        try:
+            return await call
+        finally:
+            metrics.DISCORD_LATENCY.since(start, name)
+            self._record(queued_at)
+
+    def post(self, channel, content, view=None):
+        # queues a channel message; the future gets the Message it went out in
+        queue = self.channels.get(channel.id)
+        if queue is None:
+            queue = self.channels[channel.id] = _ChannelQueue()
+        future = asyncio.get_running_loop().create_future()
+        # nobody has to wait for a post, failures are logged in _drain
+        future.add_done_callback(lambda f: f.cancelled() or f.exception())
+        queue.pending.append((content, view, future, time.monotonic()))
+        self.queued += 1
+        if queue.task is None:
+            queue.task = asyncio.create_task(self._drain(channel, queue))
+        return future
+
+    async def _drain(self, channel, queue):
+        while queue.pending:
+            delay = queue.bucket.delay()
+            if delay:
+                await asyncio.sleep(delay)
+                continue
+            batch = [queue.pending.popleft()]
+            if batch[0][1] is None:
+                length = len(batch[0][0])
+                while queue.pending and queue.pending[0][1] is None:
+                    length += 2 + len(queue.pending[0][0])
+                    if length > MAX_MESSAGE_LENGTH:
+                        break
+                    batch.append(queue.pending.popleft())
+            self.queued -= len(batch)
+            self.merged += len(batch) - 1
+            queue.bucket.take()
+            await self._acquire(NARRATION)
+            start = metrics.clock()
+            try:
+                message = await channel.send(
+                    "\n\n".join(content for content, _, _, _ in batch),
+                    view=batch[0][1],
+                )
+            except Exception as e:
+                metrics.DISCORD_LATENCY.since(start, "post")
+                logger.warning(f"Couldn't post to channel {channel.id}: {e}")
+                for _, _, future, _ in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            else:
+                metrics.DISCORD_LATENCY.since(start, "post")
+                for _, _, future, queued_at in batch:
+                    self._record(queued_at)
+                    if not future.done():
+                        future.set_result(message)
+        queue.task = None
+        # keep the bucket until it has refilled, so a burst can't reset it
+        wheel.schedule(CHANNEL_RATE[1], self._prune, channel.id, queue)
+
+    def _prune(self, channel_id, queue):
+        if self.channels.get(channel_id) is queue and queue.task is None:
+            del self.channels[channel_id]
+
+    def stats(self):
+        return {
+            "queued": self.queued,
+            "waiting": len(self.waiters[0]) + len(self.waiters[1]),
+            "channels": len(self.channels),
+            "sent": self.sent,
+            "merged": self.merged,
+            "average_latency": self.latency_total / self.sent if self.sent else 0.0,
+            "max_latency": self.latency_max,
+        }
+
+
+outbox = Outbox()
@@ -1,6 +1,7 @@
 from dataclasses import dataclass, field
 from cards import Stance, Card, AttackCard, MoveAction
 from typing import Optional
+from ai import MonteCarloAI
 import discord
 import random
 
@@ -14,10 +15,12 @@ class Player:
     emoji: str
     initial_challenge: discord.Interaction
     chosen_plays: list[AttackCard | MoveAction]
+    user_id: Optional[int] = None
     hp: int = 2
     special_used: bool = False
     locked: Optional[Card] = None
     stance: Stance = Stance.HEAVEN
+    ai: Optional[MonteCarloAI] = None
 
     def __init__(
         self,
@@ -26,7 +29,9 @@ class Player:
         name: str,
         mention: str,
         emoji: str,
-        initial_challenge: discord.Interaction,
+        initial_challenge: Optional[discord.Interaction],
+        ai: Optional[MonteCarloAI] = None,
+        user_id: Optional[int] = None,
     ):
         self.cell = cell
         self.special = special
@@ -39,6 +44,8 @@ class Player:
         self.chosen_plays = []
         self.special_used = False
         self.locked = None
+        self.ai = ai
+        self.user_id = user_id
 
     def make_state_string(self):
         stanceEmoji = "⚡" if self.stance == Stance.HEAVEN else "🏔"
@@ -0,0 +1,110 @@
+# Profiling the running bot on demand, from the owner-only /profile command.
+#
+# cprofile mode hooks cProfile into the event loop's thread for the window
+# and writes a .pstats file. sampling mode leaves the loop alone: a side
+# thread reads the loop thread's stack every few milliseconds and writes the
+# counts in folded form (one "frame;frame;frame count" line per stack, what
+# flamegraph.pl takes). Either can also diff tracemalloc snapshots taken at
+# the start and end of the window. Only one profile runs at a time, and the
+# slow parts (sampling, snapshots, writing files) stay off the event loop.
+
+import asyncio
+import cProfile
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+
+PROFILE_DIR = os.environ.get("DUELBOT_PROFILE_DIR", "profiles")
+CPROFILE = "cprofile"
+SAMPLING = "sampling"
+SAMPLE_INTERVAL = 0.005
+TOP_ALLOCATIONS = 50
+
+running = False
+
+
+async def profile(seconds, mode=CPROFILE, memory=False, active_matches=0):
+    # returns the paths written
+    global running
+    if running:
+        raise RuntimeError("A profile is already running")
+    running = True
+    try:
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        stem = os.path.join(
+            PROFILE_DIR, f"{time.strftime('%Y%m%d-%H%M%S')}-{active_matches}matches"
+        )
+        # leave tracemalloc running if someone else started it
+        started_tracemalloc = memory and not tracemalloc.is_tracing()
+        if started_tracemalloc:
+            tracemalloc.start()
+        try:
+            before = (
+                await asyncio.to_thread(tracemalloc.take_snapshot) if memory else None
+            )
+            if mode == CPROFILE:
+                paths = [await _cprofile(seconds, stem)]
+            else:
+                paths = [await _sampling(seconds, stem)]
+            if memory:
+                after = await asyncio.to_thread(tracemalloc.take_snapshot)
+                paths.append(await asyncio.to_thread(_write_diff, before, after, stem))
+        finally:
+            if started_tracemalloc:
+                tracemalloc.stop()
+        return paths
+    finally:
+        running = False
+
+
+async def _cprofile(seconds, stem):
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        profiler.disable()
+    path = f"{stem}.pstats"
+    await asyncio.to_thread(profiler.dump_stats, path)
+    return path
+
+
+async def _sampling(seconds, stem):
+    stacks = await asyncio.to_thread(_sample, threading.get_ident(), seconds)
+    path = f"{stem}.folded"
+    lines = [f"{stack} {count}" for stack, count in stacks.most_common()]
+    await asyncio.to_thread(_write_lines, path, lines)
+    return path
+
+
+def _sample(thread_id, seconds):
+    stacks = Counter()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        frame = sys._current_frames().get(thread_id)
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            frames.append(
+                f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+            )
+            frame = frame.f_back
+        if frames:
+            stacks[";".join(reversed(frames))] += 1
+        time.sleep(SAMPLE_INTERVAL)
+    return stacks
+
+
+def _write_diff(before, after, stem):
+    path = f"{stem}.tracemalloc.diff"
+    stats = after.compare_to(before, "lineno")
+    _write_lines(path, [str(stat) for stat in stats[:TOP_ALLOCATIONS]])
+    return path
+
+
+def _write_lines(path, lines):
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
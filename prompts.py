@@ -0,0 +1,101 @@
+# Stateless button routing.
+#
+# A button's custom_id says everything needed to route a click:
+# "duel:<match id>:<turn>:<step>:<value>", with the ids in hex. Prompts are
+# sent with a view that has already been stopped, so discord.py doesn't keep
+# anything per message, and every click arrives at main.on_interaction, which
+# hands it to router.dispatch. The only state is one entry per player who is
+# waiting on a click, keyed by (match id, user id).
+
+import asyncio
+import discord
+import metrics
+from timers import wheel
+
+PREFIX = "duel"
+# which prompt of a turn a button belongs to
+FIRST = 0
+SECOND = 1
+CONTINUE = 2
+# both plays from one message; the value says which menu was used
+COMBINED = 3
+
+
+def custom_id(match_id, turn, step, value):
+    return f"{PREFIX}:{match_id:x}:{turn:x}:{step}:{value:x}"
+
+
+def parse(custom_id):
+    # (match id, turn, step, value), or None if it isn't one of ours
+    parts = custom_id.split(":")
+    if len(parts) != 5 or parts[0] != PREFIX:
+        return None
+    try:
+        return tuple(int(part, 16) for part in parts[1:])
+    except ValueError:
+        return None
+
+
+def make_view(match_id, turn, step, buttons_with_values):
+    view = discord.ui.View(timeout=None)
+    for button, value in buttons_with_values:
+        button.custom_id = custom_id(match_id, turn, step, value)
+        view.add_item(button)
+    # a finished view is still sent, but discord.py doesn't hold on to it
+    view.stop()
+    return view
+
+
+class PromptRouter:
+    def __init__(self):
+        # (match id, user id) -> (turn, step, future)
+        self.waiting = {}
+
+    async def wait(
+        self, match_id, user_id, turn, step, timeout, warn_before=None, warn=None
+    ):
+        # (value, interaction) for the player's click, or TimeoutError.
+        # warn() is called warn_before seconds ahead of the deadline.
+        key = (match_id, user_id)
+        future = asyncio.get_running_loop().create_future()
+        self.waiting[key] = (turn, step, future)
+        timers = [wheel.schedule(timeout, _expire, future)]
+        if warn is not None and warn_before and timeout > warn_before:
+            timers.append(wheel.schedule(timeout - warn_before, warn))
+        start = metrics.clock()
+        try:
+            result = await future
+            metrics.PROMPT_WAIT.since(start, step)
+            return result
+        except TimeoutError:
+            metrics.PROMPT_TIMEOUTS.inc(step)
+            raise
+        finally:
+            for timer in timers:
+                timer.cancel()
+            if key in self.waiting and self.waiting[key][2] is future:
+                del self.waiting[key]
+
+    async def dispatch(self, interaction: discord.Interaction):
+        # returns whether the click was one of ours
+        parsed = parse(interaction.data.get("custom_id", ""))
+        if parsed is None:
+            return False
+        match_id, turn, step, value = parsed
+        waiting = self.waiting.get((match_id, interaction.user.id))
+        if waiting is None or waiting[:2] != (turn, step) or waiting[2].done():
+            await interaction.response.send_message(
+                "This button isn't waiting on you any more.", ephemeral=True
+            )
+            return True
+        # the waiting duel responds to the interaction itself
+        waiting[2].set_result((value, interaction))
+        return True
+
+
+def _expire(future):
+    if not future.done():
+        future.set_exception(TimeoutError())
+
+
+router = PromptRouter()
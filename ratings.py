@@ -0,0 +1,141 @@
+# Elo ratings with an in-memory leaderboard.
+#
+# Each guild has its own RankIndex and there is one for everyone across all
+# guilds (stored under GLOBAL). A RankIndex counts players per whole rating
+# point in a Fenwick tree, so updating a player, looking up a rank and
+# finding the top N are all O(log n) in the rating range and never sort or
+# scan the ratings table. It is rebuilt from the database at startup.
+
+STARTING_RATING = 1500.0
+K_FACTOR = 32
+GLOBAL = 0
+# ratings are clamped to this many whole points for indexing
+RATING_RANGE = 4096
+
+
+def expected_score(rating, opponent_rating):
+    return 1 / (1 + 10 ** ((opponent_rating - rating) / 400))
+
+
+def elo_update(winner_rating, loser_rating):
+    change = K_FACTOR * (1 - expected_score(winner_rating, loser_rating))
+    return winner_rating + change, loser_rating - change
+
+
+def _bucket(rating):
+    return min(max(int(rating), 0), RATING_RANGE - 1)
+
+
+class RankIndex:
+    def __init__(self):
+        self.tree = [0] * (RATING_RANGE + 1)
+        # bucket -> {user_id: rating}
+        self.buckets = {}
+        self.size = 0
+
+    def _add(self, bucket, delta):
+        i = bucket + 1
+        while i <= RATING_RANGE:
+            self.tree[i] += delta
+            i += i & -i
+
+    def _count_below(self, bucket):
+        # players in buckets lower than bucket
+        total = 0
+        i = bucket
+        while i > 0:
+            total += self.tree[i]
+            i -= i & -i
+        return total
+
+    def _find(self, k):
+        # lowest bucket holding the k-th lowest player, 1-based
+        position = 0
+        step = 1 << (RATING_RANGE.bit_length() - 1)
+        while step:
+            if position + step <= RATING_RANGE and self.tree[position + step] < k:
+                position += step
+                k -= self.tree[position]
+            step >>= 1
+        return position
+
+    def add(self, user_id, rating):
+        bucket = _bucket(rating)
+        self.buckets.setdefault(bucket, {})[user_id] = rating
+        self._add(bucket, 1)
+        self.size += 1
+
+    def remove(self, user_id, rating):
+        bucket = _bucket(rating)
+        members = self.buckets[bucket]
+        del members[user_id]
+        if not members:
+            del self.buckets[bucket]
+        self._add(bucket, -1)
+        self.size -= 1
+
+    def rank(self, rating):
+        # 1 + players in higher buckets; players within a point share a rank
+        return 1 + self.size - self._count_below(_bucket(rating) + 1)
+
+    def top(self, n):
+        # [(user_id, rating), ...] best first
+        result = []
+        seen = 0
+        while len(result) < n and seen < self.size:
+            bucket = self._find(self.size - seen)
+            members = sorted(self.buckets[bucket].items(), key=lambda m: -m[1])
+            result.extend(members[: n - len(result)])
+            seen += len(members)
+        return result
+
+
+class Leaderboard:
+    def __init__(self):
+        # (user_id, guild_id) -> (rating, games)
+        self.ratings = {}
+        self.indexes = {}
+
+    def _index(self, guild_id):
+        if guild_id not in self.indexes:
+            self.indexes[guild_id] = RankIndex()
+        return self.indexes[guild_id]
+
+    def load(self, rows):
+        # rows of (user_id, guild_id, rating, games) from the database
+        for user_id, guild_id, rating, games in rows:
+            self.ratings[(user_id, guild_id)] = (rating, games)
+            self._index(guild_id).add(user_id, rating)
+
+    def rating(self, user_id, guild_id):
+        return self.ratings.get((user_id, guild_id), (STARTING_RATING, 0))[0]
+
+    def _set(self, user_id, guild_id, rating):
+        index = self._index(guild_id)
+        old_rating, games = self.ratings.get((user_id, guild_id), (None, 0))
+        if old_rating is not None:
+            index.remove(user_id, old_rating)
+        index.add(user_id, rating)
+        self.ratings[(user_id, guild_id)] = (rating, games + 1)
+        return (user_id, guild_id, rating, games + 1)
+
+    def record_result(self, guild_id, winner_id, loser_id):
+        # updates the guild and global ratings, returns the rows to persist
+        rows = []
+        for scope in (guild_id, GLOBAL):
+            winner_rating, loser_rating = elo_update(
+                self.rating(winner_id, scope), self.rating(loser_id, scope)
+            )
+            rows.append(self._set(winner_id, scope, winner_rating))
+            rows.append(self._set(loser_id, scope, loser_rating))
+        return rows
+
+    def top(self, guild_id, n=10):
+        return self._index(guild_id).top(n)
+
+    def rank(self, user_id, guild_id):
+        # (rank, rating), or None if the player has no rated games here
+        if (user_id, guild_id) not in self.ratings:
+            return None
+        rating = self.ratings[(user_id, guild_id)][0]
+        return self._index(guild_id).rank(rating), rating
@@ -0,0 +1,260 @@
+# Append-only binary replay log.
+#
+# Replays are appended to segment files in a directory. Each segment starts
+# with MAGIC, followed by records of:
+#
+#   RECORD header | p1 emoji | p2 emoji | 4 play ids per turn
+#
+# The emojis are utf-8, with their byte lengths in the header. Each turn is
+# (p1 first, p1 second, p2 first, p2 second), one byte per play id. The
+# header starts with the record's total size, so a reader can step through
+# a memory-mapped segment record by record and stop at a torn tail left by
+# a crash.
+
+import mmap
+import os
+import struct
+from typing import NamedTuple
+
+import engine
+
+MAGIC = b"DUELRPL1"
+# size, turns, match_id, guild_id, p1_id, p2_id, seed, started_at,
+# ended_at, p1_special, p2_special, winner (0 none, 1 or 2), flags,
+# p1 emoji length, p2 emoji length
+RECORD = struct.Struct("<IHQQQQQddBBBBBB")
+FORFEIT = 1
+P2_AI = 2
+SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class Replay(NamedTuple):
+    match_id: int
+    guild_id: int
+    p1_id: int
+    p2_id: int
+    seed: int
+    started_at: float
+    ended_at: float
+    p1_special: int
+    p2_special: int
+    winner: int
+    flags: int
+    p1_emoji: str
+    p2_emoji: str
+    plays: bytes
+
+    @property
+    def turns(self):
+        return len(self.plays) // 4
+
+    def turn(self, i):
+        return tuple(self.plays[i * 4 : i * 4 + 4])
+
+
+def _emoji_bytes(emoji):
+    # lengths are stored in a byte, drop whole characters until it fits
+    while len(emoji.encode()) > 255:
+        emoji = emoji[:-1]
+    return emoji.encode()
+
+
+def encode(game_state, guild_id):
+    p1 = game_state.p1
+    p2 = game_state.p2
+    p1_emoji = _emoji_bytes(p1.emoji)
+    p2_emoji = _emoji_bytes(p2.emoji)
+    plays = bytes(p for turn in game_state.play_log for p in turn)
+    if game_state.winner is None:
+        winner = 0
+    else:
+        winner = 1 if game_state.winner is p1 else 2
+    flags = (FORFEIT if game_state.forfeit else 0) | (P2_AI if p2.ai else 0)
+    header = RECORD.pack(
+        RECORD.size + len(p1_emoji) + len(p2_emoji) + len(plays),
+        len(game_state.play_log),
+        game_state.match_id,
+        guild_id or 0,
+        p1.user_id or 0,
+        p2.user_id or 0,
+        game_state.seed,
+        game_state.started_at,
+        game_state.ended_at,
+        p1.special.id,
+        p2.special.id,
+        winner,
+        flags,
+        len(p1_emoji),
+        len(p2_emoji),
+    )
+    return header + p1_emoji + p2_emoji + plays
+
+
+def _records(buffer, offset=len(MAGIC)):
+    # (end offset, Replay) for each complete record
+    end = len(buffer)
+    while offset + RECORD.size <= end:
+        (
+            size,
+            turns,
+            *fields,
+            p1_emoji_length,
+            p2_emoji_length,
+        ) = RECORD.unpack_from(buffer, offset)
+        if (
+            size != RECORD.size + p1_emoji_length + p2_emoji_length + turns * 4
+            or offset + size > end
+        ):
+            return
+        start = offset + RECORD.size
+        p1_emoji = bytes(buffer[start : start + p1_emoji_length]).decode()
+        start += p1_emoji_length
+        p2_emoji = bytes(buffer[start : start + p2_emoji_length]).decode()
+        start += p2_emoji_length
+        plays = bytes(buffer[start : start + turns * 4])
+        offset += size
+        yield offset, Replay(*fields, p1_emoji, p2_emoji, plays)
+
+
+class ReplayReader:
+    # Memory maps one segment; iterate it for Replays.
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        if os.fstat(self._file.fileno()).st_size < len(MAGIC):
+            # can't mmap an empty file
+            self._file.close()
+            raise ValueError(f"{path} is not a replay segment")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[: len(MAGIC)] != MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not a replay segment")
+
+    def __iter__(self):
+        for _, replay in _records(self._map):
+            yield replay
+
+    def valid_length(self):
+        # length up to the end of the last complete record
+        end = len(MAGIC)
+        for end, _ in _records(self._map):
+            pass
+        return end
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def _headerless(path):
+    # a crash right after creating a segment can leave it without its MAGIC
+    return os.path.getsize(path) < len(MAGIC)
+
+
+def segments(directory):
+    if not os.path.isdir(directory):
+        return []
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(".seg")
+    )
+
+
+def read_replays(directory):
+    for path in segments(directory):
+        if _headerless(path):
+            continue
+        with ReplayReader(path) as reader:
+            yield from reader
+
+
+def find_replay(directory, match_id):
+    for replay in read_replays(directory):
+        if replay.match_id == match_id:
+            return replay
+    return None
+
+
+class ReplayLog:
+    # Appends encoded matches to the newest segment, starting a new one once
+    # it passes segment_size. Nothing is opened until the first append; a
+    # torn record at the end of the newest segment is cut off then.
+    def __init__(self, directory, segment_size=SEGMENT_SIZE):
+        self.directory = directory
+        self.segment_size = segment_size
+        self._index = None
+        self._file = None
+
+    def _open(self):
+        os.makedirs(self.directory, exist_ok=True)
+        existing = segments(self.directory)
+        self._index = int(os.path.basename(existing[-1])[:-4]) if existing else 0
+        if existing and _headerless(existing[-1]):
+            self._file = open(existing[-1], "wb")
+            self._file.write(MAGIC)
+            self._file.flush()
+        elif existing:
+            with ReplayReader(existing[-1]) as reader:
+                valid = reader.valid_length()
+            self._file = open(existing[-1], "r+b")
+            self._file.truncate(valid)
+            self._file.seek(valid)
+
+    def _next_segment(self):
+        if self._file is not None:
+            self._file.close()
+        self._index += 1
+        path = os.path.join(self.directory, f"{self._index:08d}.seg")
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._file.flush()
+
+    def append(self, game_state, guild_id):
+        if self._index is None:
+            self._open()
+        if self._file is None or self._file.tell() >= self.segment_size:
+            self._next_segment()
+        self._file.write(encode(game_state, guild_id))
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def rebuild(replay, p1_name="Player 1", p2_name="Player 2"):
+    # Plays the match back through GameState, yielding (summary lines,
+    # engine state) after each turn.
+    from game import GameState, SavedMember  # pulls in discord
+
+    game = GameState(
+        SavedMember(replay.p1_id, p1_name),
+        SavedMember(replay.p2_id, p2_name),
+        None,
+        None,
+        None,
+        replay.p1_emoji,
+        replay.p2_emoji,
+        seed=replay.seed,
+    )
+    game.p1.special = engine.PLAYS[replay.p1_special]
+    game.p2.special = engine.PLAYS[replay.p2_special]
+    for i in range(replay.turns):
+        plays = replay.turn(i)
+        for player, (first, second) in ((game.p1, plays[:2]), (game.p2, plays[2:])):
+            player.clear_plays()
+            player.add_queued_play(engine.PLAYS[first])
+            player.add_queued_play(engine.PLAYS[second])
+        game.resolve_plays(True)
+        if game.check_for_game_end()[0] is None:
+            game.resolve_plays(False)
+        yield list(game.turn_summary), game.engine_state(True)
+        game.turn_summary.clear()
@@ -0,0 +1,229 @@
+# Batched duel simulator for balance analysis.
+#
+# Holds N duels as numpy arrays and resolves a turn-half for all of them at
+# once using engine.TRANSITIONS, so nothing in here knows the rules itself.
+# Run `python simulate.py [games] [workers] [seed]` for a random-play report.
+
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import engine
+
+# transition table split into one array per field, indexed by transition index
+_TRANSITIONS = np.array([t[:6] for t in engine.TRANSITIONS], dtype=np.int8)
+NEXT_C1, NEXT_S1, NEXT_C2, NEXT_S2, DAMAGE1, DAMAGE2 = _TRANSITIONS.T.copy()
+
+IS_SPECIAL = np.array(engine.IS_SPECIAL, dtype=bool)
+LOCKS = np.array(engine.LOCKS, dtype=np.int8)
+CHANGES_STANCE = np.array(engine.CHANGES_STANCE, dtype=np.int8)
+
+SPECIALS = np.array(
+    [i for i in range(engine.NUM_PLAYS) if engine.IS_SPECIAL[i]], dtype=np.int8
+)
+legal_index = engine.legal_index
+
+
+def _build_legal_table():
+    # engine.LEGAL_PLAYS padded into a rectangular array
+    counts = np.array([len(legal) for legal in engine.LEGAL_PLAYS], dtype=np.int8)
+    plays = np.zeros((len(engine.LEGAL_PLAYS), engine.NUM_PLAYS), dtype=np.int8)
+    for i, legal in enumerate(engine.LEGAL_PLAYS):
+        plays[i, : len(legal)] = legal
+    return counts, plays
+
+
+LEGAL_COUNTS, LEGAL_PLAYS = _build_legal_table()
+
+
+def random_policy(rng, legal):
+    # picks uniformly from the legal plays at each row of legal table indexes
+    choice = (rng.random(len(legal)) * LEGAL_COUNTS[legal]).astype(np.int8)
+    return LEGAL_PLAYS[legal, choice]
+
+
+class Simulation:
+    def __init__(self, games, seed=None, policy=random_policy):
+        self.rng = np.random.default_rng(seed)
+        self.policy = policy
+        self.games = games
+
+        # specials are dealt like GameState does, p2 never gets p1's special
+        p1pick = self.rng.integers(0, len(SPECIALS), games)
+        p2pick = (p1pick + self.rng.integers(1, len(SPECIALS), games)) % len(SPECIALS)
+        self.sp1 = SPECIALS[p1pick]
+        self.sp2 = SPECIALS[p2pick]
+
+        self.c1 = np.zeros(games, dtype=np.int8)
+        self.c2 = np.full(games, engine.BOARD_SIZE - 1, dtype=np.int8)
+        self.s1 = np.full(games, engine.HEAVEN, dtype=np.int8)
+        self.s2 = np.full(games, engine.HEAVEN, dtype=np.int8)
+        self.hp1 = np.full(games, engine.STARTING_HP, dtype=np.int8)
+        self.hp2 = np.full(games, engine.STARTING_HP, dtype=np.int8)
+        self.l1 = np.zeros(games, dtype=np.int8)
+        self.l2 = np.zeros(games, dtype=np.int8)
+        self.u1 = np.zeros(games, dtype=np.int8)
+        self.u2 = np.zeros(games, dtype=np.int8)
+
+        # 0 while running, otherwise the winning side
+        self.winner = np.zeros(games, dtype=np.int8)
+        self.turns = np.zeros(games, dtype=np.int32)
+        self.turn_halves = 0
+
+    def choose_plays(self, locked, stance, special, used):
+        # widen before indexing, the int8 arrays would overflow
+        locked = locked.astype(np.intp)
+        first = self.policy(self.rng, legal_index(locked, stance, special, used, 0))
+        second = self.policy(
+            self.rng,
+            legal_index(
+                locked,
+                stance ^ CHANGES_STANCE[first],
+                special,
+                used | IS_SPECIAL[first],
+                LOCKS[first],
+            ),
+        )
+        return first, second
+
+    def resolve_half(self, active, p1play, p2play, is_second_half):
+        c1 = self.c1[active]
+        c2 = self.c2[active]
+        # transition_index over whole arrays
+        index = (
+            (
+                ((c1.astype(np.intp) * engine.BOARD_SIZE + c2) * 2 + self.s1[active])
+                * 2
+                + self.s2[active]
+            )
+            * engine.NUM_PLAYS
+            + p1play
+        ) * engine.NUM_PLAYS + p2play
+        self.c1[active] = NEXT_C1[index]
+        self.c2[active] = NEXT_C2[index]
+        self.s1[active] = NEXT_S1[index]
+        self.s2[active] = NEXT_S2[index]
+        self.hp1[active] -= DAMAGE1[index]
+        self.hp2[active] -= DAMAGE2[index]
+        self.u1[active] |= IS_SPECIAL[p1play]
+        self.u2[active] |= IS_SPECIAL[p2play]
+        if is_second_half:
+            self.l1[active] = LOCKS[p1play]
+            self.l2[active] = LOCKS[p2play]
+        self.turn_halves += len(active)
+
+        self.winner[active[self.hp1[active] <= 0]] = 2
+        self.winner[active[self.hp2[active] <= 0]] = 1
+
+    def play_turn(self, active):
+        p1first, p1second = self.choose_plays(
+            self.l1[active], self.s1[active], self.sp1[active], self.u1[active]
+        )
+        p2first, p2second = self.choose_plays(
+            self.l2[active], self.s2[active], self.sp2[active], self.u2[active]
+        )
+        self.turns[active] += 1
+
+        self.resolve_half(active, p1first, p2first, False)
+        still_going = self.winner[active] == 0
+        active = active[still_going]
+        self.resolve_half(active, p1second[still_going], p2second[still_going], True)
+
+    def run(self, max_turns=200):
+        for _ in range(max_turns):
+            active = np.flatnonzero(self.winner == 0)
+            if not len(active):
+                break
+            self.play_turn(active)
+        return self.report()
+
+    def tally(self):
+        # raw counts, which add up across simulations
+        finished = self.winner != 0
+        specials = {}
+        for special in SPECIALS:
+            holds1 = finished & (self.sp1 == special)
+            holds2 = finished & (self.sp2 == special)
+            games = holds1.sum() + holds2.sum()
+            wins = (holds1 & (self.winner == 1)).sum() + (
+                holds2 & (self.winner == 2)
+            ).sum()
+            specials[engine.PLAYS[special].name] = (int(games), int(wins))
+        return {
+            "games": self.games,
+            "finished": int(finished.sum()),
+            "turn_halves": self.turn_halves,
+            "turns": int(self.turns[finished].sum()),
+            "p1_wins": int((self.winner == 1).sum()),
+            "specials": specials,
+        }
+
+    def report(self):
+        return summarise(self.tally())
+
+
+def merge(tallies):
+    total = None
+    for tally in tallies:
+        if total is None:
+            total = {**tally, "specials": dict(tally["specials"])}
+            continue
+        for key in ("games", "finished", "turn_halves", "turns", "p1_wins"):
+            total[key] += tally[key]
+        for name, (games, wins) in tally["specials"].items():
+            total_games, total_wins = total["specials"][name]
+            total["specials"][name] = (total_games + games, total_wins + wins)
+    return total
+
+
+def summarise(tally):
+    finished = tally["finished"]
+    return {
+        "games": tally["games"],
+        "unfinished": tally["games"] - finished,
+        "turn_halves": tally["turn_halves"],
+        "average_turns": tally["turns"] / finished if finished else 0.0,
+        "p1_win_rate": tally["p1_wins"] / max(finished, 1),
+        "special_win_rates": {
+            name: wins / games if games else 0.0
+            for name, (games, wins) in tally["specials"].items()
+        },
+    }
+
+
+def _run_chunk(games, seed):
+    simulation = Simulation(games, seed)
+    simulation.run()
+    return simulation.tally()
+
+
+def run_parallel(games, workers=None, seed=None):
+    # Splits the games across processes. Each chunk gets its own stream
+    # spawned from one SeedSequence, so a run is reproducible from the seed
+    # and worker count and the chunks never share a generator.
+    workers = workers or os.cpu_count() or 1
+    streams = np.random.SeedSequence(seed).spawn(workers)
+    chunks = [games // workers + (i < games % workers) for i in range(workers)]
+    with ProcessPoolExecutor(workers) as executor:
+        tallies = executor.map(_run_chunk, chunks, streams)
+        return summarise(merge(tallies))
+
+
+if __name__ == "__main__":
+    games = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    workers = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else None
+    start = time.perf_counter()
+    if workers > 1:
+        report = run_parallel(games, workers, seed)
+    else:
+        report = Simulation(games, seed).run()
+    seconds = time.perf_counter() - start
+    print(f"Simulated {games:,} duels in {seconds:.2f}s")
+    print(f"{report['turn_halves'] / seconds:,.0f} turn-halves/s")
+    print(f"Unfinished: {report['unfinished']}")
+    print(f"Average game length: {report['average_turns']:.2f} turns")
+    print(f"P1 win rate: {report['p1_win_rate'] * 100:.2f}%")
+    for name, rate in report["special_win_rates"].items():
+        print(f"{name} win rate: {rate * 100:.2f}%")
@@ -0,0 +1,278 @@
+# Equilibrium solver for the whole duel.
+#
+# Each turn is a simultaneous-move game where both players pick a (first,
+# second) pair of plays. The solver walks every turn-start state reachable
+# from the opening deals, solves each state's matrix game by regret matching
+# inside value iteration, and writes p1's win probability plus both mixed
+# strategies to a compact file that EquilibriumTable loads without numpy.
+#
+# Both specials are treated as known to both players, so this is the value of
+# the perfect-information version of the game.
+#
+# Run `python solver.py [path]` to build the file.
+
+import sys
+import time
+import struct
+from array import array
+from bisect import bisect_left
+import engine
+
+DEFAULT_PATH = "equilibrium.bin"
+MAGIC = b"DUELEQ1\0"
+_HEADER = struct.Struct("<8sII")
+
+# successor ids for finished duels
+P1_WINS = -1
+P2_WINS = -2
+
+
+def opening_states():
+    specials = [i for i in range(engine.NUM_PLAYS) if engine.IS_SPECIAL[i]]
+    return [
+        engine.initial_state(p1_special, p2_special)
+        for p1_special in specials
+        for p2_special in specials
+        if p1_special != p2_special
+    ]
+
+
+def _turn_start(state):
+    # special_used comes back from step() as a bool, keep the key canonical
+    return tuple(int(value) for value in state)
+
+
+def explore(log=print):
+    # returns (states, successors) where successors[i] is a flat list of the
+    # next state id (or P1_WINS/P2_WINS) for every p1 pair x p2 pair
+    import numpy as np
+
+    ids = {}
+    states = []
+    successors = []
+
+    def state_id(state):
+        if state not in ids:
+            ids[state] = len(states)
+            states.append(state)
+        return ids[state]
+
+    for state in opening_states():
+        state_id(_turn_start(state))
+
+    i = 0
+    while i < len(states):
+        state = states[i]
+        p1pairs = engine.legal_pairs(state, 0)
+        p2pairs = engine.legal_pairs(state, 1)
+        first_halves = {}
+        row = []
+        for p1first, p1second in p1pairs:
+            for p2first, p2second in p2pairs:
+                if (p1first, p2first) not in first_halves:
+                    first_halves[(p1first, p2first)] = engine.step(
+                        state, p1first, p2first
+                    )[0]
+                after = first_halves[(p1first, p2first)]
+                if not engine.winner(after):
+                    after = engine.step(after, p1second, p2second)[0]
+                result = engine.winner(after)
+                if result == 1:
+                    row.append(P1_WINS)
+                elif result == 2:
+                    row.append(P2_WINS)
+                else:
+                    row.append(state_id(_turn_start(after)))
+        successors.append(
+            np.array(row, dtype=np.int32).reshape(len(p1pairs), len(p2pairs))
+        )
+        i += 1
+        if i % 10000 == 0:
+            log(f"Explored {i} states, {len(states)} discovered")
+    return states, successors
+
+
+def solve_matrix_games(payoffs, iterations):
+    # batched regret matching+ with alternating updates and linear averaging;
+    # payoffs is (games, rows, cols) of p1 win probability, p1 maximises
+    import numpy as np
+
+    games, rows, cols = payoffs.shape
+    x = np.full((games, rows), 1 / rows, dtype=payoffs.dtype)
+    y = np.full((games, cols), 1 / cols, dtype=payoffs.dtype)
+    rx = np.zeros_like(x)
+    ry = np.zeros_like(y)
+    avg_x = np.zeros_like(x)
+    avg_y = np.zeros_like(y)
+
+    def normalise(regrets, fallback):
+        total = regrets.sum(axis=1, keepdims=True)
+        return np.where(total > 0, regrets / np.where(total > 0, total, 1), fallback)
+
+    for t in range(1, iterations + 1):
+        ux = np.einsum("knm,km->kn", payoffs, y)
+        rx = np.maximum(rx + ux - (x * ux).sum(axis=1, keepdims=True), 0)
+        x = normalise(rx, 1 / rows)
+        uy = -np.einsum("kn,knm->km", x, payoffs)
+        ry = np.maximum(ry + uy - (y * uy).sum(axis=1, keepdims=True), 0)
+        y = normalise(ry, 1 / cols)
+        avg_x += t * x
+        avg_y += t * y
+
+    avg_x /= avg_x.sum(axis=1, keepdims=True)
+    avg_y /= avg_y.sum(axis=1, keepdims=True)
+    values = np.einsum("kn,knm,km->k", avg_x, payoffs, avg_y)
+    return values, avg_x, avg_y
+
+
+def solve(
+    states,
+    successors,
+    iterations=64,
+    tolerance=1e-3,
+    max_sweeps=200,
+    final_iterations=256,
+    log=print,
+):
+    import numpy as np
+
+    n = len(states)
+    # group states by matrix shape so each group solves as one batch
+    groups = {}
+    for i, matrix in enumerate(successors):
+        groups.setdefault(matrix.shape, []).append(i)
+    batches = []
+    for shape, members in groups.items():
+        succ = np.stack([successors[i] for i in members])
+        # terminal outcomes point at two fixed slots after the real states
+        succ = np.where(succ == P1_WINS, n, np.where(succ == P2_WINS, n + 1, succ))
+        batches.append((np.array(members), succ))
+
+    values = np.full(n + 2, 0.5, dtype=np.float32)
+    values[n] = 1.0
+    values[n + 1] = 0.0
+
+    def sweep(iterations):
+        new_values = values.copy()
+        policies = []
+        for members, succ in batches:
+            v, x, y = solve_matrix_games(values[succ], iterations)
+            new_values[members] = v
+            policies.append((x, y))
+        return new_values, policies
+
+    # regret matching is only approximate, so the sweeps stop at a small
+    # tolerance and the stored policies come from one more precise sweep
+    for i in range(max_sweeps):
+        new_values, policies = sweep(iterations)
+        change = float(np.abs(new_values - values).max())
+        values = new_values
+        log(f"Sweep {i + 1}: max value change {change:.5f}")
+        if change < tolerance:
+            break
+    values, policies = sweep(final_iterations)
+
+    p1_policies = [None] * n
+    p2_policies = [None] * n
+    for (members, _), (x, y) in zip(batches, policies):
+        for row, i in enumerate(members):
+            p1_policies[i] = x[row]
+            p2_policies[i] = y[row]
+    return values[:n], p1_policies, p2_policies
+
+
+def _quantise(probability):
+    return round(min(max(float(probability), 0.0), 1.0) * 65535)
+
+
+def write_table(path, states, values, p1_policies, p2_policies):
+    order = sorted(range(len(states)), key=lambda i: engine.pack(states[i]))
+    keys = array("I", (engine.pack(states[i]) for i in order))
+    quantised_values = array("H", (_quantise(values[i]) for i in order))
+    offsets = array("I", [0])
+    probs = array("H")
+    for i in order:
+        for policy in (p1_policies[i], p2_policies[i]):
+            probs.extend(_quantise(p) for p in policy)
+        offsets.append(len(probs))
+
+    arrays = (keys, quantised_values, offsets, probs)
+    if sys.byteorder != "little":
+        for a in arrays:
+            a.byteswap()
+    with open(path, "wb") as f:
+        f.write(_HEADER.pack(MAGIC, len(keys), len(probs)))
+        for a in arrays:
+            a.tofile(f)
+
+
+class EquilibriumTable:
+    def __init__(self, path=DEFAULT_PATH):
+        with open(path, "rb") as f:
+            magic, n, n_probs = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != MAGIC:
+                raise ValueError(f"{path} is not an equilibrium table")
+            self.keys = array("I")
+            self.keys.fromfile(f, n)
+            self.values = array("H")
+            self.values.fromfile(f, n)
+            self.offsets = array("I")
+            self.offsets.fromfile(f, n + 1)
+            self.probs = array("H")
+            self.probs.fromfile(f, n_probs)
+        if sys.byteorder != "little":
+            for a in (self.keys, self.values, self.offsets, self.probs):
+                a.byteswap()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def _index(self, state):
+        key = engine.pack(state)
+        i = bisect_left(self.keys, key)
+        if i == len(self.keys) or self.keys[i] != key:
+            return None
+        return i
+
+    def win_probability(self, state):
+        # p1's chance of winning from a turn-start state, None if unknown
+        i = self._index(state)
+        return None if i is None else self.values[i] / 65535
+
+    def policy(self, state, side):
+        # [((first, second), probability), ...] for one side, None if unknown
+        i = self._index(state)
+        if i is None:
+            return None
+        pairs = engine.legal_pairs(state, side)
+        start = self.offsets[i]
+        if side == 1:
+            start += len(engine.legal_pairs(state, 0))
+        weights = self.probs[start : start + len(pairs)]
+        total = sum(weights) or 1
+        return [(pair, w / total) for pair, w in zip(pairs, weights)]
+
+    def choose(self, state, side, rng):
+        policy = self.policy(state, side)
+        if policy is None:
+            return None
+        pairs, weights = zip(*policy)
+        return rng.choices(pairs, weights)[0]
+
+
+if __name__ == "__main__":
+    path = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_PATH
+    start = time.perf_counter()
+    states, successors = explore()
+    print(f"Explored {len(states)} states in {time.perf_counter() - start:.1f}s")
+    values, p1_policies, p2_policies = solve(states, successors)
+    write_table(path, states, values, p1_policies, p2_policies)
+    print(f"Wrote {path} in {time.perf_counter() - start:.1f}s")
+    table = EquilibriumTable(path)
+    for state in opening_states():
+        p1_special = engine.PLAYS[state[engine.P1_SPECIAL]].name
+        p2_special = engine.PLAYS[state[engine.P2_SPECIAL]].name
+        print(
+            f"{p1_special} vs {p2_special}: "
+            f"p1 wins {table.win_probability(state) * 100:.1f}%"
+        )
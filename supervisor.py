@@ -0,0 +1,149 @@
+# Runs every duel as a tracked task.
+#
+# At most max_matches duels run at once, and at most max_per_guild from one
+# guild; the rest wait in a bounded FIFO queue and start as slots free up.
+# A duel that waits longer than max_wait is dropped and handed to expire(),
+# since the interactions it was started with stop working after 15 minutes.
+# drain() is for shutdown: it stops taking duels and cancels the running
+# ones between turn-halves, leaving their journals behind so they resume on
+# the next start.
+
+import asyncio
+import logging
+import os
+from collections import deque
+from timers import wheel
+
+logger = logging.getLogger(__name__)
+
+MAX_MATCHES = int(os.environ.get("DUELBOT_MAX_MATCHES", "500"))
+MAX_MATCHES_PER_GUILD = int(os.environ.get("DUELBOT_MAX_MATCHES_PER_GUILD", "50"))
+MAX_QUEUED = int(os.environ.get("DUELBOT_MAX_QUEUED", "200"))
+# leaves a minute of the interactions' 15 to start the duel in
+MAX_WAIT = 14 * 60
+
+STARTED = "started"
+QUEUED = "queued"
+REJECTED = "rejected"
+
+
+class MatchSupervisor:
+    def __init__(
+        self,
+        run,
+        expire=None,
+        max_matches=MAX_MATCHES,
+        max_per_guild=MAX_MATCHES_PER_GUILD,
+        max_queued=MAX_QUEUED,
+        max_wait=MAX_WAIT,
+    ):
+        # run(game_state, guild_id) plays a duel out and cleans up after it,
+        # expire(game_state, guild_id) cleans up after one that waited too long
+        self.run = run
+        self.expire = expire
+        self.max_wait = max_wait
+        self.max_matches = max_matches
+        self.max_per_guild = max_per_guild
+        self.max_queued = max_queued
+        # match_id -> (task, game_state)
+        self.running = {}
+        # guild_id -> running duels
+        self.guild_counts = {}
+        # (game_state, guild_id, expiry timer) waiting for a slot
+        self.waiting = deque()
+        self.draining = False
+        self.failed = 0
+        self.expired = 0
+
+    def _has_room(self, guild_id):
+        return (
+            len(self.running) < self.max_matches
+            and self.guild_counts.get(guild_id, 0) < self.max_per_guild
+        )
+
+    def submit(self, game_state, guild_id):
+        if self.draining:
+            return REJECTED
+        if self._has_room(guild_id):
+            self._start(game_state, guild_id)
+            return STARTED
+        if len(self.waiting) >= self.max_queued:
+            return REJECTED
+        entry = [game_state, guild_id, None]
+        entry[2] = wheel.schedule(self.max_wait, self._expire, entry)
+        self.waiting.append(entry)
+        return QUEUED
+
+    def _expire(self, entry):
+        try:
+            self.waiting.remove(entry)
+        except ValueError:
+            return
+        self.expired += 1
+        if self.expire is not None:
+            self.expire(entry[0], entry[1])
+
+    def _start(self, game_state, guild_id):
+        task = asyncio.create_task(self._supervise(game_state, guild_id))
+        self.running[game_state.match_id] = (task, game_state)
+        self.guild_counts[guild_id] = self.guild_counts.get(guild_id, 0) + 1
+
+    async def _supervise(self, game_state, guild_id):
+        try:
+            await self.run(game_state, guild_id)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            # run is meant to clean up after itself, this is the backstop
+            self.failed += 1
+            logger.exception(f"Duel {game_state.match_id} failed")
+        finally:
+            del self.running[game_state.match_id]
+            self.guild_counts[guild_id] -= 1
+            if not self.guild_counts[guild_id]:
+                del self.guild_counts[guild_id]
+            if not self.draining:
+                self._start_waiting()
+
+    def _start_waiting(self):
+        # first come first served, skipping guilds that are at their cap
+        skipped = deque()
+        while self.waiting and len(self.running) < self.max_matches:
+            entry = self.waiting.popleft()
+            game_state, guild_id, timer = entry
+            if self._has_room(guild_id):
+                timer.cancel()
+                self._start(game_state, guild_id)
+            else:
+                skipped.append(entry)
+        skipped.extend(self.waiting)
+        self.waiting = skipped
+
+    async def drain(self, timeout=10):
+        self.draining = True
+        for _, _, timer in self.waiting:
+            timer.cancel()
+        self.waiting.clear()
+        tasks = []
+        for task, game_state in list(self.running.values()):
+            # wait out a turn-half being resolved, so the journal has it
+            try:
+                await asyncio.wait_for(game_state.lock.acquire(), timeout)
+            except asyncio.TimeoutError:
+                task.cancel()
+            else:
+                task.cancel()
+                game_state.lock.release()
+            tasks.append(task)
+        if tasks:
+            await asyncio.wait(tasks, timeout=timeout)
+        logger.info(f"Stopped {len(tasks)} duel(s) for shutdown")
+
+    def stats(self):
+        return {
+            "running": len(self.running),
+            "waiting": len(self.waiting),
+            "guilds": len(self.guild_counts),
+            "failed": self.failed,
+            "expired": self.expired,
+        }
@@ -0,0 +1,88 @@
+# Hashed timer wheel.
+#
+# One task ticks through a ring of slots; a timer lives in the slot its
+# deadline falls in, with a count of how many more laps of the ring to wait.
+# Scheduling and cancelling are O(1) and there is no asyncio timer handle
+# per deadline, so thousands of waiting prompts cost one wakeup per tick.
+# Timers fire to within a tick of their deadline.
+
+import asyncio
+import logging
+import math
+
+logger = logging.getLogger(__name__)
+
+
+class Timer:
+    __slots__ = ("callback", "args", "rounds", "slot", "wheel")
+
+    def __init__(self, wheel, slot, rounds, callback, args):
+        self.wheel = wheel
+        self.slot = slot
+        self.rounds = rounds
+        self.callback = callback
+        self.args = args
+
+    def cancel(self):
+        if self.slot is not None:
+            self.wheel._slots[self.slot].discard(self)
+            self.wheel.count -= 1
+            self.slot = None
+
+    @property
+    def active(self):
+        return self.slot is not None
+
+
+class TimerWheel:
+    def __init__(self, tick=1.0, size=512):
+        self.tick = tick
+        self.size = size
+        self._slots = [set() for _ in range(size)]
+        self._cursor = 0
+        self._task = None
+        # timers waiting to fire
+        self.count = 0
+
+    def schedule(self, delay, callback, *args):
+        # calls callback(*args) on the loop after about delay seconds
+        ticks = max(1, math.ceil(delay / self.tick))
+        slot = (self._cursor + ticks) % self.size
+        timer = Timer(self, slot, (ticks - 1) // self.size, callback, args)
+        self._slots[slot].add(timer)
+        self.count += 1
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+        return timer
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        next_tick = loop.time()
+        while True:
+            next_tick += self.tick
+            await asyncio.sleep(max(0, next_tick - loop.time()))
+            self._cursor = (self._cursor + 1) % self.size
+            self._advance()
+
+    def _advance(self):
+        slot = self._slots[self._cursor]
+        due = []
+        for timer in slot:
+            if timer.rounds:
+                timer.rounds -= 1
+            else:
+                due.append(timer)
+        for timer in due:
+            timer.cancel()
+            try:
+                timer.callback(*timer.args)
+            except Exception:
+                logger.exception("Timer callback failed")
+
+    def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+wheel = TimerWheel()
@@ -0,0 +1,66 @@
+# Per-duel trace, for working out what a duel did after the fact.
+#
+# Each duel keeps a fixed-size ring of compact event tuples, recorded only
+# when tracing is on (DUELBOT_TRACE=1). Nothing is formatted while a duel
+# runs; the ring is turned into text by dump(), which main calls when a duel
+# fails or gets stuck, and on SIGUSR1 for every running duel.
+
+import os
+import time
+from collections import deque
+import engine
+
+ENABLED = os.environ.get("DUELBOT_TRACE", "") not in ("", "0")
+TRACE_SIZE = 256
+
+# (seed,)
+STARTED = 0
+# (turn, p1 first, p1 second, p2 first, p2 second) play ids
+CHOSEN = 1
+# (p1 play, p2 play, engine state after, engine events)
+RESOLVED = 2
+# (winner side or None, forfeit, turns, Discord calls)
+FINISHED = 3
+# ()
+REAPED = 4
+
+
+def _plays(*play_ids):
+    return ", ".join(engine.PLAYS[p].name for p in play_ids)
+
+
+FORMATS = {
+    STARTED: lambda seed: f"started, seed {seed}",
+    CHOSEN: lambda turn, *plays: (
+        f"turn {turn + 1}: p1 plays {_plays(*plays[:2])}, p2 plays {_plays(*plays[2:])}"
+    ),
+    RESOLVED: lambda p1_play, p2_play, state, events: (
+        f"resolved {_plays(p1_play)} against {_plays(p2_play)} -> {state} {events}"
+    ),
+    FINISHED: lambda winner, forfeit, turns, calls: (
+        f"finished after {turns} turn(s), "
+        f"{'no winner' if winner is None else f'p{winner} won'}"
+        f"{' by forfeit' if forfeit else ''}, {calls} Discord calls"
+    ),
+    REAPED: lambda: "called off, stuck",
+}
+
+
+class Trace:
+    __slots__ = ("enabled", "events", "started")
+
+    def __init__(self, size=TRACE_SIZE, enabled=None):
+        self.enabled = ENABLED if enabled is None else enabled
+        # (seconds since the trace started, kind, fields)
+        self.events = deque(maxlen=size)
+        self.started = time.monotonic()
+
+    def record(self, kind, *fields):
+        if self.enabled:
+            self.events.append((time.monotonic() - self.started, kind, fields))
+
+    def dump(self):
+        return [
+            f"{offset:9.3f} {FORMATS[kind](*fields)}"
+            for offset, kind, fields in self.events
+        ]